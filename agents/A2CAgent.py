@@ -3,13 +3,14 @@ import numpy as np
 import tensorflow as tf
 
 from agents.rl.a2c_v2_est import A2C
-from agents.rl.utils.functions import softmax, argmax
+from agents.rl.utils.policy import softmax
 
 class A2CAgent(object):
 
     def __init__(self,
                  action_num=2,
                  state_shape=None,
+                 trainble=True,
                  
                  critic_mlp_layers=[4,256],
                  critic_activation_func='tanh', 
@@ -31,6 +32,9 @@ class A2CAgent(object):
                  max_entropy_part=0.9,
                  
                  max_grad_norm = 0,
+                 drop_remainder = False,
+                 
+                 shared_memory = None,
                  
                  min_reward=0,
                  max_reward=100):
@@ -39,6 +43,7 @@ class A2CAgent(object):
         self.bot = A2C(
             num_state_params=state_shape[0],
             num_actions=action_num,
+            trainble=trainble,
             
             critic_hidden_units=np.full((critic_mlp_layers[0]), critic_mlp_layers[1]), 
             critic_learning_rate=critic_learning_rate,
@@ -60,6 +65,9 @@ class A2CAgent(object):
             max_entropy_part=max_entropy_part,
             
             max_grad_norm = max_grad_norm,
+            drop_remainder = drop_remainder,
+                 
+            shared_memory = shared_memory,
             )
            
         # Total timesteps
@@ -90,6 +98,20 @@ class A2CAgent(object):
         
         self.total_t += 1
         
+    def feed_trajectory(self, trajectory):
+        if len(trajectory) == 0:
+            return
+        
+        (states, actions, rewards, next_states, dones) = tuple(zip(*trajectory))
+        self.bot.feed_batch({
+            'state': [state['obs'] for state in states],
+            'action': actions,
+            'reward': (np.asarray(rewards)-self.min_reward) / (self.max_reward-self.min_reward),
+            'next_state': [next_state['obs'] for next_state in next_states],
+            'done': dones})
+        
+        self.total_t += len(trajectory)
+        
     def train(self):
         
         loss = self.bot.train()
@@ -106,17 +128,53 @@ class A2CAgent(object):
     def step(self, state):
         return self.bot.get_action(state['obs'], state['legal_actions'])
     
+    def batch_step(self, states, seats=None):
+        '''
+        Выбор действий для состояний с нескольких столов за один вызов сети
+
+        '''
+        return self.bot.get_actions(
+            [state['obs'] for state in states], 
+            [state['legal_actions'] for state in states])
+    
     def eval_step(self, state):
         
         batch = [state['obs']]
         ts = tf.convert_to_tensor(batch)
         
         logits,_ = self.bot.predict(ts)
-        probs = self.bot.softmax(logits, state['legal_actions'])[0]
+        probs = softmax(logits, [state['legal_actions']])[0]
         best_action = np.argmax(probs)
         
         return best_action, probs
     
+    def batch_eval_step(self, states, seats=None):
+        '''
+        Лучшие действия для батча состояний за один проход сети
+
+        Parameters
+        ----------
+        states : list
+            Состояния игры (словари с 'obs' и 'legal_actions').
+        seats : list, optional
+            Не используется, для совместимости с BatchedRollout. The default is None.
+
+        Returns
+        -------
+        actions : array
+            DESCRIPTION.
+        probs : array
+            Вероятности действий, форма (batch, num_actions).
+
+        '''
+        batch = np.asarray([state['obs'] for state in states], dtype='float32')
+        
+        logits = self.bot.predict_policy(tf.convert_to_tensor(batch))
+        probs = softmax(logits, [state['legal_actions'] for state in states])
+        best_actions = np.argmax(probs, axis=1)
+        
+        return best_actions, probs
+    
     def save_model(self, path):
         self.bot.save_model(path)
         
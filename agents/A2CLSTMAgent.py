@@ -3,7 +3,7 @@ import numpy as np
 import tensorflow as tf
 
 from agents.rl.a2c_v2_lstm import A2CLSTM
-from agents.rl.utils.functions import softmax, argmax
+from agents.rl.utils.policy import softmax
 
 class A2CLSTMAgent(object):
 
@@ -35,9 +35,15 @@ class A2CLSTMAgent(object):
                  max_entropy_part=0.9,
                  
                  max_grad_norm = 0,
+                 drop_remainder = False,
                  
                  shared_memory = None,
                  
+                 #eval_step и batch_eval_step без прохода окна; логиты со
+                 #второго хода отличаются от окна, на котором обучается
+                 #актёр, поэтому step и batch_step всегда используют окно
+                 stateful_inference = False,
+                 
                  min_reward=0,
                  max_reward=100):
         self.use_raw = False
@@ -46,7 +52,7 @@ class A2CLSTMAgent(object):
             num_state_params=state_shape[0],
             num_actions=action_num,
             timesteps = timesteps,
-            trainble=trainble,
+            trainable=trainble,
             
             critic_lstm_units=np.full((critic_lstm_layers[0]), critic_lstm_layers[1]), 
             critic_hidden_units=np.full((critic_mlp_layers[0]), critic_mlp_layers[1]), 
@@ -70,8 +76,11 @@ class A2CLSTMAgent(object):
             max_entropy_part=max_entropy_part,
             
             max_grad_norm = max_grad_norm,
+            drop_remainder = drop_remainder,
                  
             shared_memory = shared_memory,
+            
+            stateful_inference = stateful_inference,
             )
            
         # Total timesteps
@@ -101,6 +110,20 @@ class A2CLSTMAgent(object):
         
         self.total_t += 1
         
+    def feed_trajectory(self, trajectory):
+        if len(trajectory) == 0:
+            return
+        
+        (states, actions, rewards, next_states, dones) = tuple(zip(*trajectory))
+        self.bot.feed_batch({
+            'state': [state['obs'] for state in states],
+            'action': actions,
+            'reward': (np.asarray(rewards)-self.min_reward) / (self.max_reward-self.min_reward),
+            'next_state': [next_state['obs'] for next_state in next_states],
+            'done': dones})
+        
+        self.total_t += len(trajectory)
+        
     def train(self):
         loss = self.bot.train()
         
@@ -117,19 +140,63 @@ class A2CLSTMAgent(object):
     def step(self, state):
         return self.bot.get_action(state['obs'], state['legal_actions'])
     
+    def batch_step(self, states, seats):
+        '''
+        Выбор действий для состояний с нескольких столов за один вызов сети.
+        seats - места (стол, игрок), история lstm хранится для каждого
+        места отдельно.
+
+        '''
+        return self.bot.get_actions(
+            [state['obs'] for state in states], 
+            [state['legal_actions'] for state in states],
+            seats)
+    
     def eval_step(self, state):
         
-        self.bot.lstm.add_data(state['obs'])
-        batch = [self.bot.lstm.get_data()]
-        ts = tf.convert_to_tensor(batch)
-        
-        logits,_ = self.bot.predict(ts) 
-        probs = softmax(logits, state['legal_actions'])[0]
+        logits = self.bot.step_policy(state['obs'])
+        probs = softmax(logits, [state['legal_actions']])[0]
         best_action = np.argmax(probs)
         return best_action, probs
     
-    def reset_lstm_memory(self):
-        self.bot.reset_lstm_memory()
+    def batch_eval_step(self, states, seats=None):
+        '''
+        Лучшие действия для батча состояний за один проход сети
+
+        Parameters
+        ----------
+        states : list
+            Состояния игры (словари с 'obs' и 'legal_actions').
+        seats : list, optional
+            Места (стол, игрок), история lstm хранится для каждого места
+            отдельно. The default is None - каждое состояние оценивается
+            без истории, во временном месте, которое удаляется после
+            вызова (история eval_step и других мест не меняется).
+
+        Returns
+        -------
+        actions : array
+            DESCRIPTION.
+        probs : array
+            Вероятности действий, форма (batch, num_actions).
+
+        '''
+        temporary = seats is None
+        if temporary:
+            seats = [('batch_eval_step', row) for row in range(len(states))]
+        
+        logits = self.bot.step_policy_batch([state['obs'] for state in states], seats)
+        probs = softmax(logits, [state['legal_actions'] for state in states])
+        best_actions = np.argmax(probs, axis=1)
+        
+        if temporary:
+            for seat in seats:
+                self.bot.reset_lstm_memory(seat)
+        
+        return best_actions, probs
+    
+    def reset_lstm_memory(self, seat=None):
+        self.bot.reset_lstm_memory(seat)
         
     def save_model(self, path):
         self.bot.save_model(path)
@@ -6,6 +6,7 @@ import tensorflow as tf
 from collections import namedtuple
 
 from agents.rl.ddqn import DDQN
+from agents.rl.utils.policy import softmax, argmax
 
 class DDQNAgent(object):
 
@@ -13,6 +14,7 @@ class DDQNAgent(object):
                  replay_memory_size=10000,
                  replay_memory_init_size=100,
                  update_target_estimator_every=1000,
+                 tau=1.0,
                  discount_factor=0.95,
                  epsilon=1,
                  min_epsilon=0.1,
@@ -21,10 +23,18 @@ class DDQNAgent(object):
                  action_num=2,
                  state_shape=None,
                  train_every=1,
+                 replay_ratio=None,
+                 merge_batches=False,
                  mlp_layers=[4,512],
                  learning_rate=0.00005,
                  activation_func='tanh', 
-                 kernel_initializer='glorot_uniform'):
+                 kernel_initializer='glorot_uniform',
+                 prioritized_replay=False,
+                 priority_alpha=0.6,
+                 priority_beta=0.4,
+                 priority_beta_increment=0.0001,
+                 replay_memory_path=None,
+                 n_step=1):
     
         self.use_raw = False
         self.replay_memory_init_size = replay_memory_init_size
@@ -38,6 +48,19 @@ class DDQNAgent(object):
         # Total training step
         self.train_t = 0
         self.train_every = train_every
+        
+        # Replay ratio: sampled transitions per collected transition.
+        # By default one batch every train_every transitions
+        if replay_ratio is None:
+            self.train_steps_per_chunk = 1
+        else:
+            self.train_steps_per_chunk = train_every * replay_ratio / batch_size
+        self.replay_ratio = replay_ratio
+        # Spend the owed steps as one step on a merged batch
+        # (fewer, larger batches) instead of several batch_size steps
+        self.merge_batches = merge_batches
+        # Training steps owed to the scheduler (fractional part is carried over)
+        self.train_steps_owed = 0.0
 
         # The epsilon decay scheduler
         self.epsilon = epsilon
@@ -55,7 +78,15 @@ class DDQNAgent(object):
             batch_size=batch_size, 
             learning_rate=learning_rate,
             activation_func=activation_func, 
-            kernel_initializer=kernel_initializer
+            kernel_initializer=kernel_initializer,
+            prioritized_replay=prioritized_replay,
+            priority_alpha=priority_alpha,
+            priority_beta=priority_beta,
+            priority_beta_increment=priority_beta_increment,
+            memory_path=replay_memory_path,
+            n_step=n_step,
+            update_target_net_every=update_target_estimator_every,
+            tau=tau
             )
 
     def feed(self, ts):
@@ -71,17 +102,67 @@ class DDQNAgent(object):
         self.bot.feed(state['obs'], action, reward, next_state['obs'], done)
         self.total_t += 1
         
-        tmp = self.total_t - self.replay_memory_init_size
-        if tmp >= 0 and tmp % self.train_every == 0:
-            self.train()
+        self._schedule_training(self.total_t - 1, self.total_t)
+            
+    def feed_trajectory(self, trajectory):
+        ''' Store the whole trajectory in to replay buffer with one call and
+            run the training steps that feed() would have run for it.
+        Args:
+            trajectory (list): a list of transitions of 5 elements
+        '''
+        if len(trajectory) == 0:
+            return
+        
+        (states, actions, rewards, next_states, dones) = tuple(zip(*trajectory))
+        self.bot.feed_batch({
+            'state': [state['obs'] for state in states],
+            'action': actions,
+            'reward': rewards,
+            'next_state': [next_state['obs'] for next_state in next_states],
+            'done': dones})
+        
+        start_t = self.total_t
+        self.total_t += len(trajectory)
+        
+        self._schedule_training(start_t, self.total_t)
+    
+    def _schedule_training(self, start_t, end_t):
+        ''' Replay ratio scheduler: every train_every transitions after the
+            memory is populated adds train_steps_per_chunk
+            (train_every * replay_ratio / batch_size) training steps, all whole steps owed for the chunk
+            (start_t, end_t] run with one train() call, or as one step on
+            a steps * batch_size batch when merge_batches is set
+        Args:
+            start_t (int): timestep before the chunk
+            end_t (int): timestep after the chunk
+        '''
+        for t in range(start_t + 1, end_t + 1):
+            tmp = t - self.replay_memory_init_size
+            if tmp >= 0 and tmp % self.train_every == 0:
+                self.train_steps_owed += self.train_steps_per_chunk
+        
+        steps = int(self.train_steps_owed)
+        if steps > 0:
+            self.train_steps_owed -= steps
+            if self.merge_batches:
+                self.train(1, batch_size=steps * self.batch_size)
+            else:
+                self.train(steps)
             
-    def train(self):
-        self.bot.train()
-        self.train_t += 1
-        # Update the target estimator
-        if self.train_t % self.update_target_estimator_every == 0:
-            self.bot.update_target_net()
-            print("\nINFO - Copied model parameters to target network.")
+    def train(self, steps=1, batch_size=None):
+        ''' Run steps training steps with one compiled call. The target
+            estimator is updated inside the same graph: a hard copy every
+            update_target_estimator_every steps for tau=1, Polyak averaging
+            after every step for tau<1
+            Steps skipped while the memory holds fewer than
+            replay_memory_init_size records are not counted in train_t
+        Args:
+            steps (int): number of gradient steps
+            batch_size (int): samples per step, the default is the agent's batch_size
+        '''
+        train_step = self.bot.train_step
+        self.bot.train(steps, batch_size)
+        self.train_t += self.bot.train_step - train_step
 
 
     def step(self, state):
@@ -95,11 +176,38 @@ class DDQNAgent(object):
     def eval_step(self, state):
         
         logits = self.bot.predict(state['obs'])
-        probs = self.bot.softmax(logits, state['legal_actions'])[0]
-        best_action = self.bot.argmax(logits, state['legal_actions'])[0]
+        probs = softmax(logits, [state['legal_actions']])[0]
+        best_action = argmax(logits, [state['legal_actions']])[0]
         
         return best_action, probs
     
+    def batch_eval_step(self, states, seats=None):
+        '''
+        Лучшие действия для батча состояний за один проход сети
+
+        Parameters
+        ----------
+        states : list
+            Состояния игры (словари с 'obs' и 'legal_actions').
+        seats : list, optional
+            Не используется, для совместимости с BatchedRollout. The default is None.
+
+        Returns
+        -------
+        actions : array
+            DESCRIPTION.
+        probs : array
+            Вероятности действий, форма (batch, num_actions).
+
+        '''
+        batch = np.asarray([state['obs'] for state in states], dtype='float32')
+        
+        logits = self.bot.predict(batch)
+        probs = softmax(logits, [state['legal_actions'] for state in states])
+        best_actions = np.argmax(probs, axis=1)
+        
+        return best_actions, probs
+    
     def save_model(self, path):
         self.bot.save_model(path)
         
@@ -1,11 +1,11 @@
 # -*- coding: utf-8 -*-`
-import random
 import numpy as np
 import tensorflow as tf
 import os
 
-from agents.rl.utils.memory import ReplayMemory
-from agents.rl.utils.functions import softmax, argmax, returns, returns_est, general_advantage_estimates
+from agents.rl.utils.memory import RingReplayMemory
+from agents.rl.utils.functions import sample_actions, minibatches, general_advantage_estimates_tf
+from agents.rl.utils.policy import softmax
 from agents.rl.models.neural_network_models import SimpleNeuralNetworkModel
 
 class A2C(object):
@@ -34,6 +34,7 @@ class A2C(object):
                  max_entropy_part=0.9,
                  
                  max_grad_norm = 0,
+                 drop_remainder = False,
                  
                  shared_memory = None
                  ):
@@ -49,12 +50,16 @@ class A2C(object):
         self.critic_optimizer = tf.keras.optimizers.Adam(critic_learning_rate, decay=0.99, epsilon=1e-5)
         self.actor_optimizer = tf.keras.optimizers.Adam(actor_learning_rate, decay=0.99, epsilon=1e-5)      
         self.max_grad_norm = max_grad_norm
-        self.entropy_coef = entropy_coef
+        #отбрасывать неполный последний минибатч
+        self.drop_remainder = drop_remainder
+        self.entropy_coef = tf.Variable(entropy_coef, trainable=False, dtype=tf.float32)
         self.entropy_decoy = entropy_decoy
         self.max_entropy_part = max_entropy_part
         self.gamma = gamma
         self.lam = lam
         self.train_step = 0
+        #количество трассировок шагов обучения (для тестов)
+        self.trace_counts = {'critic': 0, 'actor': 0}
         self.critic_bacth_size = critic_bacth_size
         self.actor_bacth_size = actor_bacth_size
         
@@ -86,13 +91,7 @@ class A2C(object):
         if shared_memory is not None:
             self.memory = shared_memory
         else:   
-            self.memory = ReplayMemory()
-        
-        #train memory
-        self._mb_states = []
-        self._mb_actions = []
-        self._mb_returns = []
-        self._mb_values = []
+            self.memory = RingReplayMemory()
     
     def predict(self, inputs, training=False):
         
@@ -120,12 +119,7 @@ class A2C(object):
         return self.memory.get_samples()
         
     def feed_batch(self, batch):
-        for i in range(len(batch['state'])):
-            self.feed(batch['state'][i], 
-                      batch['action'][i], 
-                      batch['reward'][i], 
-                      batch['next_state'][i], 
-                      batch['done'][i])
+        self.memory.add_replay_batch(batch)
     
     def feed(self, state, action, reward, next_state, done):
         replay = {
@@ -143,30 +137,19 @@ class A2C(object):
     def train(self):
         
         if self.trainble:
-            samples = self.memory.get_samples()
-            
-            est_values = self.predict_values(samples['state'])
-            est_next_values = self.predict_values(samples['next_state'])
+            samples = self.memory.pop_samples()
             
-            returns = general_advantage_estimates(
-                samples['reward'],
-                samples['done'], 
-                est_values, 
-                est_next_values, 
-                self.lam,
-                self.gamma)
+            states, actions, returns = self._prepare_batch(
+                np.asarray(samples['state'], dtype='float32'),
+                np.asarray(samples['next_state'], dtype='float32'),
+                np.asarray(samples['action'], dtype='int32'),
+                np.asarray(samples['reward'], dtype='float32'),
+                np.asarray(samples['done'], dtype='bool'))
             
-            indices = [i for i in range(0, len(samples['state']))]
-            random.shuffle(indices)
-        
-            states = np.asarray([samples['state'][i] for i in indices])
-            actions = np.asarray([samples['action'][i] for i in indices])
-            returns = np.asarray([returns[i] for i in indices])
-        
             critic_loss = self._critic_train(states, returns)
             policy_loss, entropy_loss, policy_entropy_loss = self._actor_train(states, actions, returns)
     
-            self.entropy_coef *= self.entropy_decoy
+            self.entropy_coef.assign(self.entropy_coef * self.entropy_decoy)
             self.train_step += 1
     
             test_state = np.asarray([samples['state'][0]])
@@ -174,7 +157,7 @@ class A2C(object):
             print("========================")
             print('train_step: ', self.train_step)
             print("------------------------")
-            print('entropy coef: ', self.entropy_coef)
+            print('entropy coef: ', self.entropy_coef.numpy())
             print("------------------------")
             print('test logit: ', test_logit)
             print("------------------------")
@@ -190,30 +173,59 @@ class A2C(object):
             print("========================")
             
             loss = [critic_loss, policy_loss, entropy_loss, policy_entropy_loss]
-            self.clear_memory()
         
         return loss
     
-    def _critic_train(self, states, returns):
+    @tf.function(input_signature=[
+        tf.TensorSpec(shape=[None, None], dtype=tf.float32),
+        tf.TensorSpec(shape=[None, None], dtype=tf.float32),
+        tf.TensorSpec(shape=[None], dtype=tf.int32),
+        tf.TensorSpec(shape=[None], dtype=tf.float32),
+        tf.TensorSpec(shape=[None], dtype=tf.bool)])
+    def _prepare_batch(self, states, next_states, actions, rewards, dones):
+        '''
+        Оценка ценностей состояний, расчёт GAE и перемешивание записей
+        в одном графе: один вызов вместо нескольких eager проходов.
 
-        critic_loss_list = []
+        Returns
+        -------
+        states, actions, returns
+            Перемешанные состояния, действия и целевые значения.
 
-        for start in range(0, self.memory.size, self.critic_bacth_size):
+        '''
+        values = self.predict_values(states)
+        next_values = self.predict_values(next_states)
+        
+        returns = general_advantage_estimates_tf(
+            rewards,
+            dones, 
+            values, 
+            next_values, 
+            self.lam,
+            self.gamma)
+        
+        indices = tf.random.shuffle(tf.range(tf.shape(states)[0]))
+        
+        return tf.gather(states, indices), tf.gather(actions, indices), tf.gather(returns, indices)
+    
+    def _critic_train(self, states, returns):
 
-            if self.memory.size > start+self.critic_bacth_size:
+        critic_loss_list = []
 
-                indices = range(start, start+self.critic_bacth_size)
-                self._mb_states=states[indices]
-                self._mb_returns=returns[indices]
+        for mb_states, mb_returns in minibatches((states, returns), self.critic_bacth_size, drop_remainder=self.drop_remainder):
                 
-                critic_loss = self._critic_train_step()
+            critic_loss = self._critic_train_step(mb_states, mb_returns)
 
-                critic_loss_list.append(critic_loss.numpy())
+            critic_loss_list.append(critic_loss.numpy())
 
         return critic_loss_list
     
-    @tf.function
-    def _critic_train_step(self):
+    @tf.function(input_signature=[
+        tf.TensorSpec(shape=[None, None], dtype=tf.float32),
+        tf.TensorSpec(shape=[None], dtype=tf.float32)])
+    def _critic_train_step(self, states, returns):
+        
+        self.trace_counts['critic'] += 1
         
         # Open a GradientTape to record the operations run
         # during the forward pass, which enables autodifferentiation.
@@ -221,8 +233,8 @@ class A2C(object):
                         
             #logits - вектор необработанных (ненормализованных) предсказаний, 
             #которые генерирует модель классификации
-            values = self.predict_values(self._mb_states)
-            value_loss = self._value_loss(self._mb_returns, values)
+            values = self.predict_values(states)
+            value_loss = self._value_loss(returns, values)
             
         # Use the gradient tape to automatically retrieve
         # the gradients of the trainable variables with respect to the loss.
@@ -245,34 +257,35 @@ class A2C(object):
         policy_loss_list = []
         policy_entropy_loss_list = []
             
-        values = self.predict_values(states).numpy()
-
-        for start in range(0, self.memory.size, self.actor_bacth_size):
-
-            if self.memory.size > start+self.actor_bacth_size:
+        values = self.predict_values(states)
+        
+        dataset = minibatches((states, actions, returns, values), self.actor_bacth_size, drop_remainder=self.drop_remainder)
 
-                indices = range(start, start+self.actor_bacth_size)
-                self._mb_states=states[indices]
-                self._mb_actions=actions[indices]
-                self._mb_returns=returns[indices]
-                self._mb_values=values[indices]
+        for mb_states, mb_actions, mb_returns, mb_values in dataset:
 
-                policy_loss, entropy_loss, policy_entropy_loss = self._actor_train_step()
+            policy_loss, entropy_loss, policy_entropy_loss = self._actor_train_step(
+                mb_states, mb_actions, mb_returns, mb_values)
 
-                entropy_loss_list.append(entropy_loss.numpy())
-                policy_loss_list.append(policy_loss.numpy())
-                policy_entropy_loss_list.append(policy_entropy_loss.numpy())
+            entropy_loss_list.append(entropy_loss.numpy())
+            policy_loss_list.append(policy_loss.numpy())
+            policy_entropy_loss_list.append(policy_entropy_loss.numpy())
 
         return policy_loss_list, entropy_loss_list, policy_entropy_loss_list 
     
-    @tf.function
-    def _actor_train_step(self):
+    @tf.function(input_signature=[
+        tf.TensorSpec(shape=[None, None], dtype=tf.float32),
+        tf.TensorSpec(shape=[None], dtype=tf.int32),
+        tf.TensorSpec(shape=[None], dtype=tf.float32),
+        tf.TensorSpec(shape=[None], dtype=tf.float32)])
+    def _actor_train_step(self, states, actions, returns, values):
+        
+        self.trace_counts['actor'] += 1
         
         with tf.GradientTape() as tape:
                         
-            policy_logits = self._actor(self._mb_states)
-            advantages = self._advantages(self._mb_returns, self._mb_values)
-            policy_loss = self._policy_loss(self._mb_actions, advantages, policy_logits)
+            policy_logits = self._actor(states)
+            advantages = self._advantages(returns, values)
+            policy_loss = self._policy_loss(actions, advantages, policy_logits)
             entropy_loss = self._entropy_loss(policy_logits)
             #clip_entropy_loss = tf.minimum(entropy_loss*self.max_entropy_part, entropy_loss)
             policy_entropy_loss = policy_loss - self.entropy_coef * entropy_loss
@@ -288,13 +301,15 @@ class A2C(object):
     
     def get_weights(self):
         weights = {
-            'critic': self._critic.get_weights(),
             'actor': self._actor.get_weights()
             }
+        if self.trainble:
+            weights['critic'] = self._critic.get_weights()
         return weights
     
     def set_weights(self, weights):
-        self._critic.set_weights(weights['critic'])
+        if self.trainble:
+            self._critic.set_weights(weights['critic'])
         self._actor.set_weights(weights['actor'])
         return weights
         
@@ -304,11 +319,22 @@ class A2C(object):
         ts = tf.convert_to_tensor(batch)
         
         logits = self.predict_policy(ts)
-        probs = softmax(logits, legal_actions)[0]
+        probs = softmax(logits, [legal_actions])[0]
         selected_action = np.random.choice(self.num_actions, p=probs)
         
         return selected_action
     
+    def get_actions(self, states, legal_actions):
+        '''
+        Выбор действий для батча состояний (например, с нескольких столов)
+        за один проход сети
+
+        '''
+        logits = self.predict_policy(tf.convert_to_tensor(np.asarray(states, dtype='float32')))
+        probs = softmax(logits, legal_actions)
+        
+        return sample_actions(probs)
+    
     def _value_loss(self, returns, values):
         
         loss =  tf.math.reduce_mean(tf.keras.losses.MSE(returns, values))
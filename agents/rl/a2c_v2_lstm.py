@@ -1,11 +1,11 @@
 # -*- coding: utf-8 -*-`
-import random
 import numpy as np
 import tensorflow as tf
 import os
 
-from agents.rl.utils.memory import ReplayMemory, LSTMemory
-from agents.rl.utils.functions import softmax, argmax, general_advantage_estimates
+from agents.rl.utils.memory import RingReplayMemory, LSTMemory
+from agents.rl.utils.functions import sample_actions, minibatches, general_advantage_estimates_tf
+from agents.rl.utils.policy import softmax
 from agents.rl.models.neural_network_models import LSTMNeuralNetworkModel
 
 class A2CLSTM(object):
@@ -37,8 +37,11 @@ class A2CLSTM(object):
                  max_entropy_part=0.9,
                  
                  max_grad_norm = 0,
+                 drop_remainder = False,
                  
-                 shared_memory = None
+                 shared_memory = None,
+                 
+                 stateful_inference = False
                  ):
         
         #Параметры игры
@@ -51,12 +54,16 @@ class A2CLSTM(object):
         self.critic_optimizer = tf.keras.optimizers.Adam(critic_learning_rate, decay=0.99, epsilon=1e-5)
         self.actor_optimizer = tf.keras.optimizers.Adam(actor_learning_rate, decay=0.99, epsilon=1e-5)      
         self.max_grad_norm = max_grad_norm
-        self.entropy_coef = entropy_coef
+        #отбрасывать неполный последний минибатч
+        self.drop_remainder = drop_remainder
+        self.entropy_coef = tf.Variable(entropy_coef, trainable=False, dtype=tf.float32)
         self.entropy_decoy = entropy_decoy
         self.max_entropy_part = max_entropy_part
         self.gamma = gamma
         self.lam = lam
         self.train_step = 0
+        #количество трассировок шагов обучения (для тестов)
+        self.trace_counts = {'critic': 0, 'actor': 0}
         self.critic_bacth_size = critic_bacth_size
         self.actor_bacth_size = actor_bacth_size
         
@@ -92,16 +99,17 @@ class A2CLSTM(object):
         if shared_memory is not None:
             self.memory = shared_memory
         else:   
-            self.memory = ReplayMemory()
-        
-        #train memory
-        self._mb_states = []
-        self._mb_actions = []
-        self._mb_returns = []
-        self._mb_values = []
+            self.memory = RingReplayMemory()
         
         #lstm
         self.lstm = LSTMemory(timesteps, (num_state_params,))
+        #окна истории для остальных мест (столов), место 0 - self.lstm
+        self.lstm_windows = {}
+        #перенос (h, c) между ходами только при оценке, см. step_policy
+        self.stateful_inference = stateful_inference
+        self.actor_states = {}
+        #начальное (h, c) актёра, пересчитывается после изменения весов
+        self.actor_initial_state = None
     
     def predict(self, inputs, training=False):
         
@@ -129,12 +137,7 @@ class A2CLSTM(object):
         return self.memory.get_samples()
         
     def feed_batch(self, batch):
-        for i in range(len(batch['state'])):
-            self.feed(batch['state'][i], 
-                      batch['action'][i], 
-                      batch['reward'][i], 
-                      batch['next_state'][i], 
-                      batch['done'][i])
+        self.memory.add_replay_batch(batch)
         
     def feed(self, state, action, reward, next_state, done):
         replay = {
@@ -152,38 +155,27 @@ class A2CLSTM(object):
     def train(self):
         
         if self.trainable:
-            samples = self.memory.get_samples()
+            samples = self.memory.pop_samples()
             
             states = self.lstm.split_to_timesteps(samples['state'], samples['done'])
-            est_values = self.predict_values(states)
             
             next_dones=np.copy(samples['done'])
             next_dones = np.roll(next_dones, -1)
             next_dones[-1] = True
             next_states = self.lstm.split_to_timesteps(samples['next_state'], next_dones)
-            est_next_values = self.predict_values(next_states)
-            
-            #returns = self._returns_est(samples['reward'], samples['done'], est_values)
-            #returns = self._returns(samples['reward'], samples['done'], est_values[-1])
-            returns = general_advantage_estimates(
-                samples['reward'],
-                samples['done'], 
-                est_values, 
-                est_next_values, 
-                self.lam,
-                self.gamma)
             
-            indices = [i for i in range(0, len(samples['state']))]
-            random.shuffle(indices)
-            
-            states = np.asarray([states[i] for i in indices])
-            actions = np.asarray([samples['action'][i] for i in indices])
-            returns = np.asarray([returns[i] for i in indices])
+            states, actions, returns = self._prepare_batch(
+                states,
+                next_states,
+                np.asarray(samples['action'], dtype='int32'),
+                np.asarray(samples['reward'], dtype='float32'),
+                np.asarray(samples['done'], dtype='bool'))
             
             critic_loss = self._critic_train(states, returns)
             policy_loss, entropy_loss, policy_entropy_loss = self._actor_train(states, actions, returns)
+            self.actor_initial_state = None
     
-            self.entropy_coef *= self.entropy_decoy
+            self.entropy_coef.assign(self.entropy_coef * self.entropy_decoy)
             self.train_step += 1
     
             test_state = np.asarray([states[0]])
@@ -191,7 +183,7 @@ class A2CLSTM(object):
             print("========================")
             print('train_step: ', self.train_step)
             print("------------------------")
-            print('entropy coef: ', self.entropy_coef)
+            print('entropy coef: ', self.entropy_coef.numpy())
             print("------------------------")
             print('test logit: ', test_logit)
             print("------------------------")
@@ -207,35 +199,64 @@ class A2CLSTM(object):
             print("========================")
             
             loss = [critic_loss, policy_loss, entropy_loss, policy_entropy_loss]
-            self.clear_memory()
         
         return loss
     
-    def _critic_train(self, states, returns):
+    @tf.function(input_signature=[
+        tf.TensorSpec(shape=[None, None, None], dtype=tf.float32),
+        tf.TensorSpec(shape=[None, None, None], dtype=tf.float32),
+        tf.TensorSpec(shape=[None], dtype=tf.int32),
+        tf.TensorSpec(shape=[None], dtype=tf.float32),
+        tf.TensorSpec(shape=[None], dtype=tf.bool)])
+    def _prepare_batch(self, states, next_states, actions, rewards, dones):
+        '''
+        Оценка ценностей состояний, расчёт GAE и перемешивание записей
+        в одном графе: один вызов вместо нескольких eager проходов.
 
-        critic_loss_list = []
+        Returns
+        -------
+        states, actions, returns
+            Перемешанные состояния, действия и целевые значения.
 
-        for start in range(0, self.memory.size, self.critic_bacth_size):
+        '''
+        values = self.predict_values(states)
+        next_values = self.predict_values(next_states)
+        
+        returns = general_advantage_estimates_tf(
+            rewards,
+            dones, 
+            values, 
+            next_values, 
+            self.lam,
+            self.gamma)
+        
+        indices = tf.random.shuffle(tf.range(tf.shape(states)[0]))
+        
+        return tf.gather(states, indices), tf.gather(actions, indices), tf.gather(returns, indices)
+    
+    def _critic_train(self, states, returns):
 
-            if self.memory.size > start+self.critic_bacth_size:
+        critic_loss_list = []
 
-                indices = range(start, start+self.critic_bacth_size)
-                self._mb_states=states[indices]
-                self._mb_returns=returns[indices]
+        for mb_states, mb_returns in minibatches((states, returns), self.critic_bacth_size, drop_remainder=self.drop_remainder):
                 
-                critic_loss = self._critic_train_step()
+            critic_loss = self._critic_train_step(mb_states, mb_returns)
 
-                critic_loss_list.append(critic_loss.numpy())
+            critic_loss_list.append(critic_loss.numpy())
 
         return critic_loss_list
     
-    @tf.function
-    def _critic_train_step(self):
+    @tf.function(input_signature=[
+        tf.TensorSpec(shape=[None, None, None], dtype=tf.float32),
+        tf.TensorSpec(shape=[None], dtype=tf.float32)])
+    def _critic_train_step(self, states, returns):
+        
+        self.trace_counts['critic'] += 1
         
         with tf.GradientTape() as tape:
                         
-            values = self.predict_values(self._mb_states)
-            value_loss = self._value_loss(self._mb_returns, values)
+            values = self.predict_values(states)
+            value_loss = self._value_loss(returns, values)
             
         value_weights = self._critic.trainable_weights
         value_gradients = tape.gradient(value_loss, value_weights)
@@ -253,34 +274,35 @@ class A2CLSTM(object):
         policy_loss_list = []
         policy_entropy_loss_list = []
             
-        values = self.predict_values(states).numpy()
-
-        for start in range(0, self.memory.size, self.actor_bacth_size):
-
-            if self.memory.size > start+self.actor_bacth_size:
+        values = self.predict_values(states)
+        
+        dataset = minibatches((states, actions, returns, values), self.actor_bacth_size, drop_remainder=self.drop_remainder)
 
-                indices = range(start, start+self.actor_bacth_size)
-                self._mb_states=states[indices]
-                self._mb_actions=actions[indices]
-                self._mb_returns=returns[indices]
-                self._mb_values=values[indices]
+        for mb_states, mb_actions, mb_returns, mb_values in dataset:
 
-                policy_loss, entropy_loss, policy_entropy_loss = self._actor_train_step()
+            policy_loss, entropy_loss, policy_entropy_loss = self._actor_train_step(
+                mb_states, mb_actions, mb_returns, mb_values)
 
-                entropy_loss_list.append(entropy_loss.numpy())
-                policy_loss_list.append(policy_loss.numpy())
-                policy_entropy_loss_list.append(policy_entropy_loss.numpy())
+            entropy_loss_list.append(entropy_loss.numpy())
+            policy_loss_list.append(policy_loss.numpy())
+            policy_entropy_loss_list.append(policy_entropy_loss.numpy())
 
         return policy_loss_list, entropy_loss_list, policy_entropy_loss_list 
     
-    @tf.function
-    def _actor_train_step(self):
+    @tf.function(input_signature=[
+        tf.TensorSpec(shape=[None, None, None], dtype=tf.float32),
+        tf.TensorSpec(shape=[None], dtype=tf.int32),
+        tf.TensorSpec(shape=[None], dtype=tf.float32),
+        tf.TensorSpec(shape=[None], dtype=tf.float32)])
+    def _actor_train_step(self, states, actions, returns, values):
+        
+        self.trace_counts['actor'] += 1
         
         with tf.GradientTape() as tape:
                         
-            policy_logits = self._actor(self._mb_states)
-            advantages = self._advantages(self._mb_returns, self._mb_values)
-            policy_loss = self._policy_loss(self._mb_actions, advantages, policy_logits)
+            policy_logits = self._actor(states)
+            advantages = self._advantages(returns, values)
+            policy_loss = self._policy_loss(actions, advantages, policy_logits)
             entropy_loss = self._entropy_loss(policy_logits)
             #clip_entropy_loss = tf.minimum(entropy_loss*self.max_entropy_part, entropy_loss)
             policy_entropy_loss = policy_loss - self.entropy_coef * entropy_loss
@@ -296,28 +318,135 @@ class A2CLSTM(object):
     
     def get_weights(self):
         weights = {
-            'critic': self._critic.get_weights(),
             'actor': self._actor.get_weights()
             }
+        if self.trainable:
+            weights['critic'] = self._critic.get_weights()
         return weights
     
     def set_weights(self, weights):
-        self._critic.set_weights(weights['critic'])
+        if self.trainable:
+            self._critic.set_weights(weights['critic'])
         self._actor.set_weights(weights['actor'])
+        self.actor_initial_state = None
         return weights
         
-    def get_action(self, state, legal_actions):
+    def step_policy(self, state, seat=0, stateful=None):
+        '''
+        Логиты политики для нового состояния игры с учётом истории.
+        При stateful через сеть проходит только новое состояние,
+        а (h, c) lstm слоёв хранятся отдельно для каждого места за столом.
+        Первый ход эпизода даёт те же логиты, что и проход окна. Дальше
+        результат приближённый: окно теряет нулевое дополнение и, когда
+        эпизод длиннее timesteps, старые состояния, а (h, c) их помнит,
+        поэтому расхождение с окном растёт с длиной эпизода.
+        Иначе история места хранится в окне LSTMemory (self.lstm для места 0)
+        и через сеть проходит всё окно.
+        
+        Актёр обучается на окнах, поэтому игры для обучения (get_action,
+        get_actions) собираются через окно, а stateful_inference (значение
+        stateful по умолчанию) действует только на оценку.
+
+        '''
+        if stateful is None:
+            stateful = self.stateful_inference
+        if stateful:
+            if seat not in self.actor_states:
+                self.actor_states[seat] = self._actor_initial_state()
+            inputs = tf.convert_to_tensor(np.atleast_2d(state), dtype=tf.float32)
+            logits, self.actor_states[seat] = self._actor.step(inputs, self.actor_states[seat])
+        else:
+            window = self._lstm_window(seat)
+            window.add_data(state)
+            logits = self.predict_policy(tf.convert_to_tensor(window.get_batch()))
         
-        self.lstm.add_data(state)
-        batch = [self.lstm.get_data()]
-        ts = tf.convert_to_tensor(batch)
+        return logits
+    
+    def get_action(self, state, legal_actions):
         
-        logits = self.predict_policy(ts)
-        probs = softmax(logits, legal_actions)[0]
+        logits = self.step_policy(state, stateful=False)
+        probs = softmax(logits, [legal_actions])[0]
         selected_action = np.random.choice(self.num_actions, p=probs)
         
         return selected_action
     
+    def step_policy_batch(self, states, seats, stateful=None):
+        '''
+        Логиты политики для батча новых состояний с разных мест (столов)
+        за один проход сети. История каждого места хранится отдельно,
+        как в step_policy.
+
+        Parameters
+        ----------
+        states : list
+            Новые состояния игры.
+        seats : list
+            Идентификаторы мест, по одному на состояние.
+        stateful : bool, optional
+            Переносить (h, c) вместо прохода окна (см. step_policy).
+            The default is None - stateful_inference.
+
+        Returns
+        -------
+        logits : TYPE
+            DESCRIPTION.
+
+        '''
+        if stateful is None:
+            stateful = self.stateful_inference
+        if stateful:
+            for seat in seats:
+                if seat not in self.actor_states:
+                    self.actor_states[seat] = self._actor_initial_state()
+            #состояния (h, c) мест объединяются по оси батча
+            batch_states = [
+                [tf.concat([self.actor_states[seat][layer][i] for seat in seats], axis=0) for i in range(2)]
+                for layer in range(len(self.actor_states[seats[0]]))]
+            inputs = tf.convert_to_tensor(np.asarray(states, dtype='float32'))
+            logits, new_states = self._actor.step(inputs, batch_states)
+            for row, seat in enumerate(seats):
+                self.actor_states[seat] = [[h[row:row+1], c[row:row+1]] for h, c in new_states]
+        else:
+            batch = np.empty((len(seats), self.timesteps, self.num_state_params), dtype='float32')
+            for row, (state, seat) in enumerate(zip(states, seats)):
+                window = self._lstm_window(seat)
+                window.add_data(state)
+                batch[row] = window.get_view()
+            logits = self.predict_policy(tf.convert_to_tensor(batch))
+        
+        return logits
+    
+    def get_actions(self, states, legal_actions, seats):
+        '''
+        Выбор действий для батча состояний с разных мест (столов)
+
+        '''
+        logits = self.step_policy_batch(states, seats, stateful=False)
+        probs = softmax(logits, legal_actions)
+        
+        return sample_actions(probs)
+    
+    def _actor_initial_state(self):
+        '''
+        Начальное (h, c) актёра для нового места (см.
+        LSTMNeuralNetworkModel.get_initial_state), считается один раз до
+        следующего изменения весов
+
+        '''
+        if self.actor_initial_state is None:
+            self.actor_initial_state = self._actor.get_initial_state()
+        
+        return self.actor_initial_state
+    
+    def _lstm_window(self, seat):
+        
+        if seat == 0:
+            return self.lstm
+        if seat not in self.lstm_windows:
+            self.lstm_windows[seat] = LSTMemory(self.timesteps, (self.num_state_params,))
+        
+        return self.lstm_windows[seat]
+    
     def _value_loss(self, returns, values):
         
         value_loss = tf.math.reduce_mean(tf.keras.losses.MSE(returns, values))
@@ -359,8 +488,16 @@ class A2CLSTM(object):
         self.predict_policy(fix)
         self._actor.predict(fix)
         
-    def reset_lstm_memory(self):
-        self.lstm.reset()
+    def reset_lstm_memory(self, seat=None):
+        if seat is None:
+            self.lstm.reset()
+            self.lstm_windows.clear()
+            self.actor_states.clear()
+        else:
+            if seat == 0:
+                self.lstm.reset()
+            self.lstm_windows.pop(seat, None)
+            self.actor_states.pop(seat, None)
         
     def save_model(self, path):
 
@@ -374,6 +511,13 @@ class A2CLSTM(object):
         self._actor.save(path+'/actor', save_format="tf")
         
     def load_model(self, path):
+        '''
+        Загрузить веса сохранённых моделей в существующие сети: загруженная
+        модель не содержит step и get_initial_state, а скомпилированные
+        шаги обучения привязаны к переменным существующих сетей.
+
+        '''
         if self.trainable:
-            self._critic = tf.keras.models.load_model(path+'/critic')
-        self._actor = tf.keras.models.load_model(path+'/actor')
\ No newline at end of file
+            self._critic.set_weights(tf.keras.models.load_model(path+'/critic').get_weights())
+        self._actor.set_weights(tf.keras.models.load_model(path+'/actor').get_weights())
+        self.actor_initial_state = None
\ No newline at end of file
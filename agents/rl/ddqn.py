@@ -6,8 +6,9 @@ import numpy as np
 import tensorflow as tf
 from collections import namedtuple
 
-from agents.rl.utils.memory import ReplayMemory
+from agents.rl.utils.memory import RingReplayMemory, PrioritizedReplayMemory, MemmapReplayMemory
 from agents.rl.models.neural_network_models import SimpleNeuralNetworkModel
+from agents.rl.utils.policy import argmax
 from pprint import pprint
 
 class DDQN(object):
@@ -23,8 +24,15 @@ class DDQN(object):
                  learning_rate=0.00005,
                  activation_func='tanh', 
                  kernel_initializer='RandomNormal',
+                 prioritized_replay=False,
+                 priority_alpha=0.6,
+                 priority_beta=0.4,
+                 priority_beta_increment=0.0001,
+                 memory_path=None,
+                 n_step=1,
                  #train_q_net_every=1,
-                 #update_target_net_every=1000
+                 update_target_net_every=1000,
+                 tau=1.0
                  ):
         '''
         DDQN алгоритм
@@ -47,10 +55,31 @@ class DDQN(object):
             DESCRIPTION. The default is 32.
         learning_rate : float32, optional
             DESCRIPTION. The default is 0.00005.
+        prioritized_replay : bool, optional
+            Использовать приоритетную выборку из памяти. The default is False.
+        priority_alpha : float, optional
+            Степень приоритизации. The default is 0.6.
+        priority_beta : float, optional
+            Начальная степень коррекции весов выборки. The default is 0.4.
+        priority_beta_increment : float, optional
+            Увеличение priority_beta после каждой выборки. The default is 0.0001.
+        memory_path : str, optional
+            Каталог для хранения памяти на диске (MemmapReplayMemory), не
+            используется вместе с prioritized_replay. The default is None.
+        n_step : int, optional
+            Количество шагов в записях памяти (n-шаговая цель с
+            дисконтом gamma**n_step). The default is 1.
         train_every : int, optional
             DESCRIPTION. The default is 1.
         update_target_net_every : int, optional
-            DESCRIPTION. The default is 1000.
+            Копировать веса в target-nn раз в update_target_net_every шагов
+            обучения (None - только вызовом update_target_net), при tau < 1
+            не используется. The default is 1000.
+        tau : float, optional
+            Коэффициент обновления target-nn: 1 - копирование весов раз в
+            update_target_net_every шагов, меньше 1 - усреднение Поляка
+            target = tau * q + (1 - tau) * target после каждого шага.
+            The default is 1.0.
 
         Returns
         -------
@@ -67,11 +96,17 @@ class DDQN(object):
         self.batch_size = batch_size
         self.optimizer = tf.keras.optimizers.Adam(learning_rate)   
         #self.train_every = train_every
-        #self.update_target_net_every = update_target_net_every
+        self.update_target_net_every = update_target_net_every
+        self.tau = tau
         self.train_step = 0
+        #количество трассировок шага обучения (для тестов): первый вызов
+        #трассирует граф дважды (создание переменных оптимизатора),
+        #дальше значение не меняется
+        self.trace_counts = {'q_net': 0}
         
         #параметры предсказания
         self.gamma = gamma
+        self.n_step = n_step
         
         #две сети-обучаемая и таргет(для обучения)
         self.q_net = SimpleNeuralNetworkModel(
@@ -86,10 +121,34 @@ class DDQN(object):
             num_actions,
             activation_func=activation_func, 
             kernel_initializer=kernel_initializer)
+        #сети строятся заранее, чтобы шаг обучения трассировался
+        #с известной размерностью входа
+        self.q_net(tf.zeros((1, num_state_params)))
+        self.target_net(tf.zeros((1, num_state_params)))
         
         #память
-        self.replay_memory = ReplayMemory(max_replay_num=max_replay_num,
-                                          min_replay_num=min_replay_num)
+        self.prioritized_replay = prioritized_replay
+        if prioritized_replay:
+            self.replay_memory = PrioritizedReplayMemory(max_replay_num=max_replay_num,
+                                                         min_replay_num=min_replay_num,
+                                                         alpha=priority_alpha,
+                                                         beta=priority_beta,
+                                                         beta_increment=priority_beta_increment,
+                                                         n_step=n_step,
+                                                         gamma=gamma)
+        elif memory_path is not None:
+            self.replay_memory = MemmapReplayMemory(memory_path,
+                                                    max_replay_num=max_replay_num,
+                                                    min_replay_num=min_replay_num,
+                                                    n_step=n_step,
+                                                    gamma=gamma)
+        else:
+            self.replay_memory = RingReplayMemory(max_replay_num=max_replay_num,
+                                                  min_replay_num=min_replay_num,
+                                                  n_step=n_step,
+                                                  gamma=gamma)
+        #массивы для выборки из памяти, выделяются при первой тренировке
+        self._batch = None
     
     def predict(self, inputs, training=False):
         return self.q_net(np.atleast_2d(inputs.astype('float32')))
@@ -111,32 +170,126 @@ class DDQN(object):
         '''
         return self.target_net(np.atleast_2d(inputs.astype('float32')))
     
-    def train(self):
+    def train(self, steps=1, batch_size=None):
         '''
-        Натренировать сеть
+        Натренировать сеть: steps шагов градиентного спуска подряд. Записи
+        для всех шагов выбираются из памяти одним вызовом, шаги выполняются
+        одним вызовом графа (_train_steps).
 
         Parameters
         ----------
-        TargetNet : TYPE
-            DESCRIPTION.
+        steps : int, optional
+            Количество шагов обучения. The default is 1.
+        batch_size : int, optional
+            Количество записей на шаге. The default is None - self.batch_size.
 
         Returns
         -------
-        TYPE
-            DESCRIPTION.
+        float
+            Средняя ошибка по шагам, 0 - если записей в памяти меньше
+            min_replay_num (шаги не выполняются и не считаются).
 
         '''
         
         if self.replay_memory.size < self.replay_memory.min_replay_num:
             return 0
         
-        #выбираем batch_size записей
-        replays = self.replay_memory.get_random_samples(self.batch_size)
-        states, actions, rewards, states_next, dones = replays.values()
+        if batch_size is None:
+            batch_size = self.batch_size
+        
+        #выбираем steps * batch_size записей
+        samples_num = steps * batch_size
+        if self._batch is None or len(self._batch['action']) != samples_num:
+            self._batch = self.replay_memory.get_batch_buffers(samples_num)
+        #записи идут в случайном порядке (приоритетная выборка перемешивает
+        #отрезки), поэтому каждый шаг получает записи из всей памяти
+        replays = self.replay_memory.get_random_samples(samples_num, out=self._batch)
+        
+        shape = (steps, batch_size)
+        states = np.asarray(replays['state'], dtype='float32').reshape(shape + (-1,))
+        actions = np.asarray(replays['action'], dtype='int32').reshape(shape)
+        rewards = np.asarray(replays['reward'], dtype='float32').reshape(shape)
+        states_next = np.asarray(replays['next_state'], dtype='float32').reshape(shape + (-1,))
+        dones = np.asarray(replays['done'], dtype='bool').reshape(shape)
+        #веса importance sampling при приоритетной выборке, 1 при обычной
+        weights = replays.get('weight')
+        if weights is None:
+            weights = np.ones(shape, dtype='float32')
+        weights = np.asarray(weights, dtype='float32').reshape(shape)
         
-        #расчитываем target_net значения
-        value_next = np.max(self._target_net_predict(states_next), axis=1)
-        target_values = np.where(dones, rewards, rewards + self.gamma * value_next)
+        loss_values, td_errors = self._train_steps(
+            states, actions, rewards, states_next, dones, weights, self.train_step)
+        self.train_step += steps
+        
+        if self.prioritized_replay:
+            self.replay_memory.update_priorities(replays['index'], td_errors.numpy().reshape(-1))
+
+        return np.mean(loss_values.numpy())
+    
+    @tf.function(input_signature=[
+        tf.TensorSpec(shape=[None, None, None], dtype=tf.float32),
+        tf.TensorSpec(shape=[None, None], dtype=tf.int32),
+        tf.TensorSpec(shape=[None, None], dtype=tf.float32),
+        tf.TensorSpec(shape=[None, None, None], dtype=tf.float32),
+        tf.TensorSpec(shape=[None, None], dtype=tf.bool),
+        tf.TensorSpec(shape=[None, None], dtype=tf.float32),
+        tf.TensorSpec(shape=[], dtype=tf.int64)])
+    def _train_steps(self, states, actions, rewards, states_next, dones, weights, train_step):
+        '''
+        Несколько шагов обучения в одном графе, первая размерность
+        аргументов - номер шага. При tau < 1 target-nn усредняется после
+        каждого шага, иначе копируется после шагов, номер которых
+        (от train_step) кратен update_target_net_every.
+
+        Returns
+        -------
+        loss_values : tensor
+            Ошибка на каждом шаге.
+        td_errors : tensor
+            Ошибки TD для обновления приоритетов, форма (steps, batch_size).
+
+        '''
+        self.trace_counts['q_net'] += 1
+        
+        steps = tf.shape(actions)[0]
+        loss_values = tf.TensorArray(tf.float32, size=steps)
+        td_errors = tf.TensorArray(tf.float32, size=steps)
+        
+        for i in tf.range(steps):
+            loss_value, td_error = self._train_step(
+                states[i], actions[i], rewards[i], states_next[i], dones[i], weights[i])
+            loss_values = loss_values.write(i, loss_value)
+            td_errors = td_errors.write(i, td_error)
+            
+            if self.tau < 1.0:
+                #усреднение Поляка - после каждого шага
+                self.update_target_net(self.tau)
+            elif self.update_target_net_every is not None:
+                if (train_step + tf.cast(i, tf.int64) + 1) % self.update_target_net_every == 0:
+                    self.update_target_net()
+        
+        return loss_values.stack(), td_errors.stack()
+    
+    def _train_step(self, states, actions, rewards, states_next, dones, weights):
+        '''
+        Шаг обучения (вызывается из графа _train_steps): double-Q цели
+        (действие выбирает q_net, оценивает target_net), функция потерь,
+        градиенты и шаг оптимизатора.
+
+        Returns
+        -------
+        loss_values : tensor
+            DESCRIPTION.
+        td_errors : tensor
+            Ошибки TD для обновления приоритетов.
+
+        '''
+        #расчитываем target_net значения для действий, выбранных q_net,
+        #записи памяти n-шаговые, поэтому дисконт gamma**n_step
+        next_actions = tf.math.argmax(self.q_net(states_next), axis=1, output_type=tf.int32)
+        value_next = tf.gather(self.target_net(states_next), next_actions, batch_dims=1)
+        target_values = tf.where(dones, rewards, rewards + self.gamma ** self.n_step * value_next)
+        target_values = tf.stop_gradient(target_values)
 
         # Open a GradientTape to record the operations run
         # during the forward pass, which enables autodifferentiation.
@@ -149,12 +302,10 @@ class DDQN(object):
                         
             #logits - вектор необработанных (ненормализованных) предсказаний, 
             #которые генерирует модель классификации
-            predicted_values = tf.math.reduce_sum(
-                self.predict(states) * tf.one_hot(actions, self.num_actions), axis=1)
+            predicted_values = tf.gather(self.q_net(states), actions, batch_dims=1)
             
             # Compute the loss value for this minibatch.            
-            #loss_values = tf.math.reduce_mean(tf.square(target_values - predicted_values))
-            loss_values  = self.loss_func(target_values, predicted_values)
+            loss_values  = self.loss_func(target_values, predicted_values, weights)
             
         # Use the gradient tape to automatically retrieve
         # the gradients of the trainable variables with respect to the loss.
@@ -164,9 +315,8 @@ class DDQN(object):
         # Run one step of gradient descent by updating
         # the value of the variables to minimize the loss.
         self.optimizer.apply_gradients(zip(gradients, variables))
-        self.train_step += 1
-
-        return loss_values.numpy()
+        
+        return loss_values, target_values - predicted_values
     
     def get_action(self, state, legal_actions, random_action_probality=0.0):
         
@@ -175,7 +325,7 @@ class DDQN(object):
         
         else:
             logits = self.predict(np.atleast_2d(state))
-            return self.argmax(logits, legal_actions)[0]
+            return argmax(logits, [legal_actions])[0]
         
     def feed(self, state, action, reward, next_state, done):
         replay = {
@@ -185,45 +335,41 @@ class DDQN(object):
             'next_state': next_state, 
             'done': done
             }
-        self.replay_memory.add_replay(replay)
+        self.replay_memory.add_transition(replay)
+        
+    def feed_batch(self, batch):
+        self.replay_memory.add_transition_batch(batch)
+
+    @tf.function
+    def update_target_net(self, tau=1.0):
+        '''
+        Обновить target-nn в графе, переменная в переменную без
+        копирования через numpy
+
+        Parameters
+        ----------
+        tau : float, optional
+            1 - копирование весов, меньше 1 - усреднение Поляка.
+            The default is 1.0.
 
-    def update_target_net(self):
+        Returns
+        -------
+        None.
+
+        '''
         variables1 = self.q_net.trainable_variables
         variables2 = self.target_net.trainable_variables
         for v1, v2 in zip(variables1, variables2):
-            v2.assign(v1.numpy())
+            if tau == 1.0:
+                v2.assign(v1)
+            else:
+                v2.assign(tau * v1 + (1.0 - tau) * v2)
     
-    def remove_illegal_actions(self, probs, legal_actions):
-        legal_probs = np.zeros_like(probs)
-        legal_probs[legal_actions] = probs[legal_actions]
-        if sum(legal_probs) == 0:
-            legal_probs[legal_actions] = 1 / legal_actions.size
+    def loss_func(self, target_values, predicted_values, weights=None):
+        if weights is None:
+            loss_values = tf.math.reduce_mean(tf.square(target_values - predicted_values))
         else:
-            legal_probs /= sum(legal_probs)
-        return legal_probs
-    
-    def softmax(self, logits, legal_actions=None):
-        
-        probs = tf.keras.activations.softmax(logits).numpy()
-        
-        legal_probs = []
-        
-        if legal_actions is not None:
-            legal_probs = [self.remove_illegal_actions(row, legal_actions) for row in probs]
-        else:
-            legal_probs = probs
-            
-        return legal_probs
-    
-    def argmax(self, logits, legal_actions=None):
-        
-        probs = self.softmax(logits, legal_actions)
-        
-        ts = tf.Variable(probs)
-        return tf.math.argmax(ts, axis=1).numpy()
-    
-    def loss_func(self, target_values, predicted_values):
-        loss_values = tf.math.reduce_mean(tf.square(target_values - predicted_values))
+            loss_values = tf.math.reduce_mean(weights * tf.square(target_values - predicted_values))
         return loss_values
     
     def save_model(self, path):
@@ -233,5 +379,12 @@ class DDQN(object):
         self.q_net.save(path, save_format="tf")
         
     def load_model(self, path):
-       self.q_net = tf.keras.models.load_model(path)
-       self.target_net = tf.keras.models.load_model(path)
\ No newline at end of file
+        '''
+        Загрузить веса сохранённой модели в существующие q_net и target_net.
+        Сети не заменяются новыми объектами: скомпилированный шаг обучения
+        (_train_steps) привязан к их переменным.
+
+        '''
+        weights = tf.keras.models.load_model(path).get_weights()
+        self.q_net.set_weights(weights)
+        self.target_net.set_weights(weights)
\ No newline at end of file
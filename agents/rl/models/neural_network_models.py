@@ -155,6 +155,12 @@ class LSTMNeuralNetworkModel(tf.keras.Model):
             activation=output_activation_func, 
             kernel_initializer=output_kernel_initializer)
         
+        #ось батча открыта, чтобы step не трассировался заново для
+        #каждого числа мест (столов) в батче
+        self.step = tf.function(self._step, input_signature=[
+            tf.TensorSpec((None, num_input), tf.float32),
+            [[tf.TensorSpec((None, units), tf.float32), tf.TensorSpec((None, units), tf.float32)]
+             for units in lstm_units]])
         
     @tf.function
     def call(self, inputs, training=None):
@@ -182,6 +188,74 @@ class LSTMNeuralNetworkModel(tf.keras.Model):
         x = self.output_layer(x)
         return x
     
+    def get_initial_state(self, batch_size=1):
+        '''
+        Состояние (h, c) lstm слоёв перед первым ходом эпизода. Окна
+        обучения (LSTMemory.split_to_timesteps) в начале эпизода дополнены
+        timesteps - 1 нулевыми записями, которые из-за смещений lstm тоже
+        меняют состояние, поэтому нулевое состояние прогоняется через
+        timesteps - 1 нулевых входов. Результат зависит от весов, при их
+        изменении его нужно пересчитать.
+
+        Parameters
+        ----------
+        batch_size : int, optional
+            DESCRIPTION. The default is 1.
+
+        Returns
+        -------
+        states : list
+            Список [h, c] для каждого lstm слоя.
+
+        '''
+        states = [[tf.zeros((1, units)), tf.zeros((1, units))]
+                  for units in self.lstm_units]
+        inputs = tf.zeros((1, self.num_input))
+        for _ in range(self.timesteps - 1):
+            _, states = self._lstm_step(inputs, states)
+        
+        return [[tf.tile(h, [batch_size, 1]), tf.tile(c, [batch_size, 1])] for h, c in states]
+    
+    def _lstm_step(self, inputs, states):
+        '''
+        Один шаг lstm слоёв: выход последнего слоя и новые [h, c]
+
+        '''
+        x = inputs
+        new_states = []
+        for lstm_layer, state in zip(self.lstm_layers, states):
+            x, new_state = lstm_layer.cell(x, state)
+            new_states.append(new_state)
+        
+        return x, new_states
+    
+    def _step(self, inputs, states):
+        '''
+        Расчёт значений модели для одного нового состояния с переносом
+        состояния (h, c) lstm слоёв между вызовами (компилируется в
+        __init__ как step)
+
+        Parameters
+        ----------
+        inputs : TYPE
+            Новое состояние игры, форма (batch, num_input).
+        states : list
+            Состояние [h, c] каждого lstm слоя (см. get_initial_state).
+
+        Returns
+        -------
+        output : TYPE
+            DESCRIPTION.
+        new_states : list
+            Новое состояние [h, c] каждого lstm слоя.
+
+        '''
+        x, new_states = self._lstm_step(inputs, states)
+        for hidden_layer in self.hidden_layers:
+            x = hidden_layer(x)
+        x = self.output_layer(x)
+        return x, new_states
+    
     def get_config(self):
         config = super(LSTMNeuralNetworkModel, self).get_config() 
         config.update({'num_input': self.num_input,
@@ -6,6 +6,8 @@ import tensorflow as tf
 from collections import namedtuple
 
 from agents.rl.models.neural_network_models import SimpleNeuralNetworkModel
+from agents.rl.utils.policy import softmax
+from agents.rl.utils.functions import discounted_cumsum
 from pprint import pprint
 
 class PolicyBased(object):
@@ -30,6 +32,10 @@ class PolicyBased(object):
         #параметры обучения
         self.optimizer = tf.keras.optimizers.Adam(learning_rate)   
         self.train_step = 0
+        #количество трассировок шага обучения (для тестов): первый вызов
+        #трассирует граф дважды (создание переменных оптимизатора),
+        #дальше значение не меняется
+        self.trace_counts = {'p_net': 0}
         
         #параметры предсказания
         self.gamma = gamma
@@ -43,35 +49,67 @@ class PolicyBased(object):
             kernel_initializer=kernel_initializer,
             output_activation_func=output_activation_func, 
             output_kernel_initializer=output_kernel_initializer)
+        #сеть строится заранее, чтобы шаг обучения трассировался
+        #с известной размерностью входа
+        self.p_net(tf.zeros((1, num_state_params)))
         
-        #memory
+        #memory, эпизоды подряд, done отмечает конец эпизода
         self.states = []
         self.actions = []
         self.rewards = []
+        self.dones = []
     
     def predict(self, inputs, training=False):
         tf_inputs = tf.convert_to_tensor(np.atleast_2d(inputs), dtype=tf.dtypes.float32)
         return self.p_net(tf_inputs)
     
-    def feed(self, state, action, reward):
+    def feed(self, state, action, reward, done=False):
         self.states.append(state)
         self.actions.append(action)
         self.rewards.append(reward)
+        self.dones.append(done)
         
     def clear_memory(self):
         self.states.clear()
         self.actions.clear()
         self.rewards.clear()
+        self.dones.clear()
     
-    @tf.function
     def train(self):
+        '''
+        REINFORCE по всем накопленным эпизодам: награды до конца эпизода
+        считаются для всех эпизодов сразу, обновление - один вызов графа.
+
+        Returns
+        -------
+        float
+            DESCRIPTION.
+
+        '''
+        if len(self.states) == 0:
+            return 0
         
-        acc_rewards = tf.convert_to_tensor(
-            self._calc_acc_rewards(self.rewards), dtype=tf.dtypes.float32)
+        dones = np.asarray(self.dones, dtype='bool')
+        #незаконченный последний эпизод обрывается концом памяти
+        dones[-1] = True
+        
+        acc_rewards = self._calc_acc_rewards(np.asarray(self.rewards, dtype='float32'), dones)
+        
+        loss_values = self._train_step(
+            np.asarray(self.states, dtype='float32'),
+            np.asarray(self.actions, dtype='int32'),
+            acc_rewards)
+        self.train_step += 1
+
+        return loss_values.numpy()
+    
+    @tf.function(input_signature=[
+        tf.TensorSpec(shape=[None, None], dtype=tf.float32),
+        tf.TensorSpec(shape=[None], dtype=tf.int32),
+        tf.TensorSpec(shape=[None], dtype=tf.float32)])
+    def _train_step(self, states, actions, acc_rewards):
         
-        # standardise the rewards
-        #acc_rewards -= np.mean(acc_rewards)
-        #acc_rewards /= np.std(acc_rewards)
+        self.trace_counts['p_net'] += 1
         
         # Open a GradientTape to record the operations run
         # during the forward pass, which enables autodifferentiation.
@@ -84,12 +122,11 @@ class PolicyBased(object):
                         
             #logits - вектор необработанных (ненормализованных) предсказаний, 
             #которые генерирует модель классификации
-            predicted_values = self.predict(self.states)
+            predicted_values = self.p_net(states)
             
             # Compute the loss value for this minibatch.            
-            #loss_values = tf.math.reduce_mean(tf.square(target_values - predicted_values))
             loss_values  = tf.math.reduce_mean(
-                self._loss_func(predicted_values, self.actions)*acc_rewards)
+                self._loss_func(predicted_values, actions)*acc_rewards)
             
         # Use the gradient tape to automatically retrieve
         # the gradients of the trainable variables with respect to the loss.
@@ -98,23 +135,13 @@ class PolicyBased(object):
         # Run one step of gradient descent by updating
         # the value of the variables to minimize the loss.
         self.optimizer.apply_gradients(zip(gradients, variables))
-        
-        '''
-        predicted_values = self.predict(self.states)                             
-        loss_values  = tf.math.reduce_mean(
-                self._loss_func(predicted_values, self.actions)*acc_rewards)
-        
-        variables = self.p_net.trainable_weights
-        self.optimizer.minimize(loss_values, variables)
-        '''
-        self.train_step += 1
 
         return loss_values
     
     def get_action(self, state, legal_actions):
         
         logits = self.predict(np.atleast_2d(state))
-        probs = self.softmax(logits, legal_actions)[0]
+        probs = softmax(logits, [legal_actions])[0]
         selected_action = np.random.choice(self.num_actions, p=probs)
         
         '''
@@ -123,30 +150,6 @@ class PolicyBased(object):
         '''
         return selected_action
     
-    def remove_illegal_actions(self, probs, legal_actions):
-        legal_probs = np.zeros_like(probs)
-        legal_probs[legal_actions] = probs[legal_actions]
-        if sum(legal_probs) == 0:
-            legal_probs[legal_actions] = 1. / len(legal_actions)
-        else:
-            legal_probs /= sum(legal_probs)
-        return legal_probs
-    
-    def softmax(self, logits, legal_actions=None):
-        
-        probs = tf.keras.activations.softmax(logits)
-        probs = probs * tf.reduce_sum(tf.one_hot(legal_actions, self.num_actions), axis=0)
-        probs = probs / tf.reduce_sum(probs, axis=1)
-            
-        return probs.numpy()
-    
-    def argmax(self, logits, legal_actions=None):
-        
-        probs = self.softmax(logits, legal_actions)
-        
-        ts = tf.Variable(probs)
-        return tf.math.argmax(ts, axis=1).numpy()
-    
     def _loss_func(self, logits, actions):
         loss_values = tf.nn.sparse_softmax_cross_entropy_with_logits(
             labels=actions, 
@@ -154,25 +157,40 @@ class PolicyBased(object):
         #cost = tf.reduce_mean(acc_rewards * loss_values)
         return loss_values
 
-    def _calc_acc_rewards(self, rewards):
-        
-        discounted_rewards = np.zeros_like(rewards)
+    def _calc_acc_rewards(self, rewards, dones):
+        '''
+        Дисконтированные награды до конца эпизода, нормированные внутри
+        каждого эпизода. Все эпизоды считаются сразу: сумма обрывается
+        на done (discounted_cumsum), среднее и отклонение - по номерам
+        эпизодов (np.bincount).
+
+        Parameters
+        ----------
+        rewards : array
+            DESCRIPTION.
+        dones : array
+            Конец эпизода.
+
+        Returns
+        -------
+        array
+            DESCRIPTION.
+
+        '''
+        discounted_rewards = discounted_cumsum(rewards, self.gamma * (1 - dones))
         
-        reward_sum = 0
-        ind = 0
-        for r in reversed(rewards):  # reverse buffer r
-            reward_sum = r + self.gamma * reward_sum
-            discounted_rewards[ind] = reward_sum
-            ind += 1
+        #номер эпизода каждого шага
+        episode_ids = np.concatenate([[0], np.cumsum(dones[:-1])])
+        counts = np.bincount(episode_ids)
         
-        mean = np.mean(discounted_rewards)
-        std = np.std(discounted_rewards)
-        if std == 0:
-            std = 1
+        mean = np.bincount(episode_ids, discounted_rewards) / counts
+        centered = discounted_rewards - mean[episode_ids]
+        std = np.sqrt(np.bincount(episode_ids, centered ** 2) / counts)
+        std[std == 0] = 1
             
-        discounted_rewards = (discounted_rewards - mean) / (std)
+        discounted_rewards = centered / std[episode_ids]
         
-        return discounted_rewards
+        return discounted_rewards.astype('float32')
     
     def save_model(self, path):
         
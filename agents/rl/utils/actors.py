@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+
+import random
+import inspect
+import queue
+import numpy as np
+import multiprocessing as mp
+
+def _inference_kwargs(agent_class, agent_kwargs):
+    '''
+    Параметры агента для копии только для вывода: без критика и без
+    обучения (параметр называется trainble или trainable в зависимости
+    от класса агента).
+
+    '''
+    kwargs = dict(agent_kwargs)
+    parameters = inspect.signature(agent_class.__init__).parameters
+    for name in ('trainble', 'trainable'):
+        if name in parameters:
+            kwargs[name] = False
+
+    return kwargs
+
+def _random_opponents(env):
+
+    from rlcard.agents import RandomAgent
+
+    return [RandomAgent(action_num=env.action_num) for _ in range(env.player_num - 1)]
+
+def _actor_worker(worker_id, env_name, seed, tables_num, agent_class, agent_kwargs,
+                  opponent_factory, weights_queue, trajectory_queue, stop_event):
+    '''
+    Процесс-актёр: играет на своих столах копией агента только для вывода
+    и отправляет траектории ученику. Перед каждой партией забирает самые
+    свежие веса из своей очереди.
+
+    '''
+    import rlcard
+    from agents.rl.utils.rollout import BatchedRollout
+
+    #rlcard.utils.set_global_seed обращается к tf.set_random_seed из TF1
+    random.seed(seed)
+    np.random.seed(seed)
+
+    agent = agent_class(**agent_kwargs)
+    #при общей памяти игр переходы пишутся прямо в неё, ученику
+    #отправляются только выигрыши
+    feed_memory = agent_kwargs.get('shared_memory') is not None
+
+    envs = []
+    for table_id in range(tables_num):
+        env = rlcard.make(env_name, config={'seed': seed + table_id})
+        env.set_agents([agent] + opponent_factory(env))
+        envs.append(env)
+    rollout = BatchedRollout(envs)
+
+    #первые веса приходят при старте пула
+    message = weights_queue.get()
+    current_version = None
+    while message is not None and not stop_event.is_set():
+        version, weights = message
+        if version != current_version:
+            agent.set_weights(weights)
+            current_version = version
+
+        trajectories, payoffs, _ = rollout.run(is_training=True)
+        for table_trajectories, table_payoffs in zip(trajectories, payoffs):
+            if feed_memory:
+                agent.feed_trajectory(table_trajectories[0])
+                table_trajectories = None
+            while not stop_event.is_set():
+                try:
+                    trajectory_queue.put((version, table_trajectories, table_payoffs), timeout=1)
+                    break
+                except queue.Full:
+                    pass
+
+        #самые свежие веса, если ученик успел их прислать
+        try:
+            while True:
+                message = weights_queue.get_nowait()
+                if message is None:
+                    break
+        except queue.Empty:
+            pass
+
+class ActorPool(object):
+    '''
+    Сбор опыта пулом процессов-актёров. Каждый процесс играет на своих
+    средах rlcard копией агента без критика (trainable=False), траектории
+    возвращаются ученику через очередь, а ученик раз в broadcast_every
+    обновлений рассылает актёрам свежие веса (get_weights/set_weights).
+
+    Процессы запускаются методом spawn, поэтому agent_class и
+    opponent_factory должны быть доступны для импорта (функции и классы
+    верхнего уровня модуля).
+
+    Если в agent_kwargs передана shared_memory (SharedReplayMemory), актёры
+    добавляют переходы прямо в неё, а get_trajectories возвращает None
+    вместо траекторий.
+    '''
+
+    def __init__(self,
+                 env_name,
+                 agent_class,
+                 agent_kwargs,
+                 workers_num=2,
+                 tables_num=1,
+                 opponent_factory=None,
+                 broadcast_every=1,
+                 seed=0,
+                 max_queue_size=100):
+        '''
+        Parameters
+        ----------
+        env_name : str
+            Имя среды rlcard.
+        agent_class : type
+            Класс агента (A2CAgent, A2CQPGAgent, ...).
+        agent_kwargs : dict
+            Параметры конструктора агента.
+        workers_num : int, optional
+            Количество процессов-актёров. The default is 2.
+        tables_num : int, optional
+            Количество столов в каждом процессе (см. BatchedRollout). The default is 1.
+        opponent_factory : callable, optional
+            opponent_factory(env) -> список агентов-соперников.
+            The default is None - случайные агенты.
+        broadcast_every : int, optional
+            Рассылать веса раз в broadcast_every обновлений ученика. The default is 1.
+        seed : int, optional
+            Базовое зерно, у каждого стола своё. The default is 0.
+        max_queue_size : int, optional
+            Размер очереди траекторий, ограничивает отставание опыта
+            от весов ученика. The default is 100.
+
+        Returns
+        -------
+        None.
+
+        '''
+        self.env_name = env_name
+        self.agent_class = agent_class
+        self.agent_kwargs = _inference_kwargs(agent_class, agent_kwargs)
+        self.workers_num = workers_num
+        self.tables_num = tables_num
+        self.opponent_factory = opponent_factory if opponent_factory is not None else _random_opponents
+        self.broadcast_every = broadcast_every
+        self.seed = seed
+
+        self.context = mp.get_context('spawn')
+        self.trajectory_queue = self.context.Queue(max_queue_size)
+        self.weights_queues = []
+        self.stop_event = self.context.Event()
+        self.workers = []
+
+        self.updates_num = 0
+        self.version = 0
+
+    def start(self, weights):
+        '''
+        Запуск процессов-актёров с начальными весами
+
+        '''
+        for worker_id in range(self.workers_num):
+            weights_queue = self.context.Queue()
+            worker = self.context.Process(
+                target=_actor_worker,
+                args=(worker_id,
+                      self.env_name,
+                      self.seed + worker_id * self.tables_num,
+                      self.tables_num,
+                      self.agent_class,
+                      self.agent_kwargs,
+                      self.opponent_factory,
+                      weights_queue,
+                      self.trajectory_queue,
+                      self.stop_event),
+                daemon=True)
+            worker.start()
+            self.weights_queues.append(weights_queue)
+            self.workers.append(worker)
+
+        self.broadcast(weights)
+
+    def broadcast(self, weights):
+        '''
+        Разослать веса всем актёрам
+
+        '''
+        self.version += 1
+        for weights_queue in self.weights_queues:
+            weights_queue.put((self.version, weights))
+
+    def update_weights(self, weights):
+        '''
+        Вызывается после каждого обновления ученика, веса рассылаются
+        раз в broadcast_every вызовов.
+
+        '''
+        self.updates_num += 1
+        if self.updates_num % self.broadcast_every == 0:
+            self.broadcast(weights)
+
+    def get_trajectories(self, min_num=1, max_num=None, timeout=None):
+        '''
+        Забрать накопленные траектории
+
+        Parameters
+        ----------
+        min_num : int, optional
+            Ждать, пока не придёт хотя бы min_num партий. The default is 1.
+        max_num : int, optional
+            Забрать не больше max_num партий. The default is None - все пришедшие.
+        timeout : float, optional
+            Время ожидания одной партии. The default is None.
+
+        Returns
+        -------
+        trajectories : list
+            Траектории игроков для каждой партии, как в env.run
+            (None, если актёры пишут в shared_memory).
+        payoffs : list
+            Выигрыши игроков для каждой партии.
+        versions : list
+            Версия весов, которыми сыграна партия.
+
+        '''
+        trajectories = []
+        payoffs = []
+        versions = []
+
+        while max_num is None or len(trajectories) < max_num:
+            try:
+                if len(trajectories) < min_num:
+                    message = self.trajectory_queue.get(timeout=timeout)
+                else:
+                    message = self.trajectory_queue.get_nowait()
+            except queue.Empty:
+                break
+
+            version, table_trajectories, table_payoffs = message
+            trajectories.append(table_trajectories)
+            payoffs.append(table_payoffs)
+            versions.append(version)
+
+        return trajectories, payoffs, versions
+
+    def stop(self, timeout=10):
+        '''
+        Остановка процессов-актёров
+
+        '''
+        self.stop_event.set()
+        for weights_queue in self.weights_queues:
+            weights_queue.put(None)
+
+        #освободить очередь, чтобы актёры не ждали на put
+        self.get_trajectories(min_num=0)
+
+        for worker in self.workers:
+            worker.join(timeout)
+            if worker.is_alive():
+                worker.terminate()
+
+        self.workers = []
+        self.weights_queues = []
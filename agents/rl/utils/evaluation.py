@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+
+import os
+import random
+import multiprocessing as mp
+from statistics import NormalDist
+
+import numpy as np
+
+def derive_seeds(seed, num):
+    '''
+    Независимые зёрна для num частей турнира, полученные из одного
+    базового зерна (numpy SeedSequence)
+
+    '''
+    #31 бит, чтобы seed + номер стола оставался допустимым зерном numpy
+    return [int(child.generate_state(1)[0] >> 1) for child in np.random.SeedSequence(seed).spawn(num)]
+
+def _tournament_worker(env_name, seed, agent_factories, model_paths, evaluate_num, tables_num):
+    '''
+    Часть турнира в отдельном процессе: агенты создаются заново и
+    загружаются из сохранённых моделей.
+
+    Returns
+    -------
+    payoffs : array
+        Выигрыши игроков в каждой партии, форма (evaluate_num, player_num).
+
+    '''
+    import rlcard
+    from agents.rl.utils.rollout import BatchedRollout
+
+    random.seed(seed)
+    np.random.seed(seed)
+
+    envs = [rlcard.make(env_name, config={'seed': seed + table_id}) for table_id in range(tables_num)]
+
+    agents = []
+    for factory, path in zip(agent_factories, model_paths):
+        agent = factory(envs[0])
+        if path is not None:
+            agent.load_model(path)
+        agents.append(agent)
+
+    for env in envs:
+        env.set_agents(agents)
+
+    _, payoffs, _ = BatchedRollout(envs).run(is_training=False, episode_num=evaluate_num)
+
+    return np.asarray(payoffs, dtype='float64').reshape(evaluate_num, -1)
+
+def parallel_tournament(env_name,
+                        agent_factories,
+                        evaluate_num,
+                        model_paths=None,
+                        workers_num=None,
+                        seed=0,
+                        tables_num=1,
+                        confidence=0.95):
+    '''
+    Турнир, разделённый между процессами. Каждый процесс играет свою
+    часть партий со своим зерном, полученным из seed, и загружает агентов
+    из model_paths. Результат - средний выигрыш каждого игрока и
+    доверительный интервал для него.
+
+    Процессы запускаются методом spawn, поэтому agent_factories должны
+    быть доступны для импорта (функции верхнего уровня модуля или
+    functools.partial от них).
+
+    Parameters
+    ----------
+    env_name : str
+        Имя среды rlcard.
+    agent_factories : list
+        agent_factory(env) -> агент, по одной на игрока.
+    evaluate_num : int
+        Общее количество партий.
+    model_paths : list, optional
+        Путь к сохранённой модели для каждого игрока (None - не загружать).
+        The default is None.
+    workers_num : int, optional
+        Количество процессов. The default is None - по числу ядер.
+    seed : int, optional
+        Базовое зерно. The default is 0.
+    tables_num : int, optional
+        Количество столов в каждом процессе (см. BatchedRollout). The default is 1.
+    confidence : float, optional
+        Уровень доверия интервала. The default is 0.95.
+
+    Returns
+    -------
+    payoffs : list
+        Средний выигрыш каждого игрока, как у rlcard.utils.tournament.
+    intervals : list
+        Полуширина доверительного интервала для каждого игрока.
+
+    '''
+    if model_paths is None:
+        model_paths = [None] * len(agent_factories)
+    if workers_num is None:
+        workers_num = os.cpu_count()
+    workers_num = max(1, min(workers_num, evaluate_num))
+
+    shards = [len(shard) for shard in np.array_split(np.arange(evaluate_num), workers_num)]
+    seeds = derive_seeds(seed, workers_num)
+    tasks = [(env_name, shard_seed, agent_factories, model_paths, shard, tables_num)
+             for shard_seed, shard in zip(seeds, shards)]
+
+    with mp.get_context('spawn').Pool(workers_num) as pool:
+        results = pool.starmap(_tournament_worker, tasks)
+
+    payoffs = np.concatenate(results, axis=0)
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+    intervals = z * payoffs.std(axis=0, ddof=1) / np.sqrt(len(payoffs)) if len(payoffs) > 1 \
+        else np.zeros(payoffs.shape[1])
+
+    return payoffs.mean(axis=0).tolist(), intervals.tolist()
+
+#состояние процесса асинхронной оценки: агент и соперники создаются один раз
+_evaluation = {}
+
+def _init_evaluation_worker(env_name, agent_class, agent_kwargs, opponent_factory):
+
+    import rlcard
+
+    env = rlcard.make(env_name)
+    _evaluation['agent'] = agent_class(**agent_kwargs)
+    _evaluation['opponents'] = opponent_factory(env)
+
+def _evaluation_worker(env_name, seed, weights, evaluate_num, tables_num):
+    '''
+    Оценка снимка весов агента против соперников в фоновом процессе.
+    Столы создаются заново с одним и тем же зерном, поэтому оценки
+    разных снимков играются на одних и тех же раздачах.
+
+    Returns
+    -------
+    float
+        Средний выигрыш агента.
+
+    '''
+    import rlcard
+    from agents.rl.utils.rollout import BatchedRollout
+
+    random.seed(seed)
+    np.random.seed(seed)
+
+    agent = _evaluation['agent']
+    agent.set_weights(weights)
+
+    envs = []
+    for table_id in range(tables_num):
+        env = rlcard.make(env_name, config={'seed': seed + table_id})
+        env.set_agents([agent] + _evaluation['opponents'])
+        envs.append(env)
+
+    _, payoffs, _ = BatchedRollout(envs).run(is_training=False, episode_num=evaluate_num)
+
+    return float(np.mean([table_payoffs[0] for table_payoffs in payoffs]))
+
+class AsyncEvaluator(object):
+    '''
+    Оценка агента в фоновом процессе, не останавливающая обучение.
+    submit передаёт снимок весов (get_weights), результат записывается в
+    Logger, когда оценка закончится (poll), в порядке отправки.
+    '''
+
+    def __init__(self,
+                 env_name,
+                 agent_class,
+                 agent_kwargs,
+                 evaluate_num,
+                 logger,
+                 opponent_factory=None,
+                 workers_num=1,
+                 tables_num=1,
+                 seed=0):
+        '''
+        Parameters
+        ----------
+        env_name : str
+            Имя среды rlcard.
+        agent_class : type
+            Класс оцениваемого агента.
+        agent_kwargs : dict
+            Параметры конструктора агента, копия создаётся без критика.
+        evaluate_num : int
+            Количество партий в одной оценке.
+        logger : rlcard.utils.Logger
+            DESCRIPTION.
+        opponent_factory : callable, optional
+            opponent_factory(env) -> список агентов-соперников.
+            The default is None - случайные агенты.
+        workers_num : int, optional
+            Количество одновременных оценок. The default is 1.
+        tables_num : int, optional
+            Количество столов в процессе (см. BatchedRollout). The default is 1.
+        seed : int, optional
+            Зерно раздач. The default is 0.
+
+        Returns
+        -------
+        None.
+
+        '''
+        from agents.rl.utils.actors import _inference_kwargs, _random_opponents
+
+        agent_kwargs = _inference_kwargs(agent_class, agent_kwargs)
+        if 'shared_memory' in agent_kwargs:
+            agent_kwargs['shared_memory'] = None
+        if opponent_factory is None:
+            opponent_factory = _random_opponents
+
+        self.env_name = env_name
+        self.evaluate_num = evaluate_num
+        self.logger = logger
+        self.tables_num = tables_num
+        self.seed = seed
+
+        self.pool = mp.get_context('spawn').Pool(
+            workers_num,
+            initializer=_init_evaluation_worker,
+            initargs=(env_name, agent_class, agent_kwargs, opponent_factory))
+        #[(timestep, AsyncResult)] в порядке отправки
+        self.pending = []
+
+    def submit(self, timestep, weights):
+        '''
+        Начать оценку снимка весов
+
+        Parameters
+        ----------
+        timestep : int
+            Шаг обучения для записи в Logger.
+        weights : dict
+            Результат get_weights агента.
+
+        Returns
+        -------
+        None.
+
+        '''
+        result = self.pool.apply_async(
+            _evaluation_worker,
+            (self.env_name, self.seed, weights, self.evaluate_num, self.tables_num))
+        self.pending.append((timestep, result))
+
+    def poll(self, wait=False):
+        '''
+        Записать в Logger законченные оценки
+
+        Parameters
+        ----------
+        wait : bool, optional
+            Дождаться всех отправленных оценок. The default is False.
+
+        Returns
+        -------
+        results : list
+            Пары (timestep, reward) записанных оценок.
+
+        '''
+        results = []
+        while len(self.pending) > 0:
+            timestep, result = self.pending[0]
+            if not wait and not result.ready():
+                break
+            reward = result.get()
+            self.logger.log_performance(timestep, reward)
+            results.append((timestep, reward))
+            self.pending.pop(0)
+
+        return results
+
+    def close(self):
+        '''
+        Дождаться оставшихся оценок и остановить процессы
+
+        '''
+        self.poll(wait=True)
+        self.pool.close()
+        self.pool.join()
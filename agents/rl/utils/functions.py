@@ -5,16 +5,48 @@ import numpy as np
 import tensorflow as tf
 from collections import namedtuple
 
-def returns(rewards, dones, last_value, gamma = 0.95):
+def discounted_cumsum(values, discounts):
+    '''
+    Обратная дисконтированная сумма y[t] = values[t] + discounts[t] * y[t+1],
+    y[T] = 0. Считается сканированием Хиллиса-Стила за log2(T) векторных
+    шагов: после шага со сдвигом s y[t] содержит сумму по [t, t+2s), а
+    discounts[t] - произведение множителей на этом отрезке. Нулевой
+    множитель (конец эпизода) обрывает сумму.
+
+    Parameters
+    ----------
+    values : array
+        DESCRIPTION.
+    discounts : array
+        Множитель перехода к следующему шагу.
+
+    Returns
+    -------
+    array
+        DESCRIPTION.
+
+    '''
+    result = np.array(values, dtype='float32')
+    discounts = np.array(discounts, dtype='float32')
+    
+    shift = 1
+    while shift < len(result):
+        result[:-shift] = result[:-shift] + discounts[:-shift] * result[shift:]
+        discounts[:-shift] = discounts[:-shift] * discounts[shift:]
+        shift *= 2
         
-    returns = np.zeros_like(rewards)
+    return result
+
+def returns(rewards, dones, last_value, gamma = 0.95):
+    
+    rewards = np.array(rewards, dtype='float32')
+    discounts = gamma * (1 - np.asarray(dones, dtype='float32'))
     
-    next_value = last_value
-    for t in reversed(range(len(rewards))):
-        returns[t] = rewards[t] + (1 - dones[t]) * gamma * next_value
-        next_value = returns[t]
+    #значение после последнего шага
+    if len(rewards) > 0:
+        rewards[-1] += discounts[-1] * last_value
         
-    return returns
+    return discounted_cumsum(rewards, discounts)
     
 def returns_est(rewards, dones, next_values, gamma = 0.95):
     
@@ -25,24 +57,66 @@ def returns_est(rewards, dones, next_values, gamma = 0.95):
 def general_advantage_estimates(rewards, dones, values, next_values, lam, gamma = 0.95):
     ### GENERALIZED ADVANTAGE ESTIMATION
     # discount/bootstrap off value fn
-    # We create mb_returns and mb_advantages
-    # mb_returns will contain Advantage + value
-    returns = np.zeros_like(rewards)
-    advantages = np.zeros_like(rewards)
-    lastgaelam = 0
-    T = len(rewards)
-    
-    # From last step to first step
-    for t in reversed(range(T)):
-        # Delta = R(st) + gamma * V(t+1) * nextnonterminal  - V(st)
-        delta = rewards[t] + (1- dones[t]) * gamma * next_values[t] - values[t]
-        # Advantage = delta + gamma *  λ (lambda) * nextnonterminal  * lastgaelam
-        advantages[t] = lastgaelam = delta + gamma * lam * (1- dones[t]) * lastgaelam
+    # returns will contain Advantage + value
+    rewards = np.asarray(rewards, dtype='float32')
+    nextnonterminal = 1 - np.asarray(dones, dtype='float32')
+    values = np.asarray(values, dtype='float32')
+    next_values = np.asarray(next_values, dtype='float32')
+    
+    # Delta = R(st) + gamma * V(t+1) * nextnonterminal  - V(st)
+    deltas = rewards + nextnonterminal * gamma * next_values - values
+    # Advantage = delta + gamma *  λ (lambda) * nextnonterminal  * next advantage
+    advantages = discounted_cumsum(deltas, gamma * lam * nextnonterminal)
     # Returns
     returns = advantages + values
     
     return returns
+
+def general_advantage_estimates_tf(rewards, dones, values, next_values, lam, gamma = 0.95):
+    ### GENERALIZED ADVANTAGE ESTIMATION (TF, для вызова внутри tf.function)
+    # обратный проход по шагам выполняется tf.scan внутри графа
+    nextnonterminal = 1.0 - tf.cast(dones, tf.float32)
     
+    deltas = rewards + nextnonterminal * gamma * next_values - values
+    advantages = tf.scan(
+        lambda lastgaelam, elem: elem[0] + elem[1] * lastgaelam,
+        (deltas, gamma * lam * nextnonterminal),
+        initializer=tf.constant(0.0),
+        reverse=True)
+    returns = advantages + values
+    
+    return returns
+    
+def minibatches(tensors, batch_size, shuffle=False, drop_remainder=False):
+    '''
+    Конвейер tf.data для обучения по минибатчам: следующий батч готовится
+    параллельно с шагом обучения (prefetch). Неполный последний батч по
+    умолчанию сохраняется, чтобы собранный опыт не терялся.
+
+    Parameters
+    ----------
+    tensors : tuple
+        Массивы/тензоры с одинаковым первым измерением.
+    batch_size : int
+        DESCRIPTION.
+    shuffle : bool, optional
+        Перемешать записи. The default is False.
+    drop_remainder : bool, optional
+        Отбросить неполный последний батч. The default is False.
+
+    Returns
+    -------
+    tf.data.Dataset
+        DESCRIPTION.
+
+    '''
+    dataset = tf.data.Dataset.from_tensor_slices(tensors)
+    if shuffle:
+        dataset = dataset.shuffle(buffer_size=len(tensors[0]))
+    dataset = dataset.batch(batch_size, drop_remainder=drop_remainder)
+    
+    return dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
 def normalize(data):
     
     mean = np.mean(data)
@@ -53,19 +127,13 @@ def normalize(data):
     
     return norm
 
-def softmax(logits, legal_actions=None):
-    
-    _, num_actions = logits.get_shape().as_list()
-    probs = tf.keras.activations.softmax(logits)
-    probs = probs * tf.reduce_sum(tf.one_hot(legal_actions, num_actions), axis=0)
-    probs = probs / tf.reduce_sum(probs, axis=1)
-        
-    return probs.numpy()
+def sample_actions(probs):
+    '''
+    Выбор действия для каждой строки батча вероятностей
+    (обратная функция распределения, один вызов генератора на батч)
 
-def argmax(logits, legal_actions=None):
-    
-    probs = softmax(logits, legal_actions)
-    ts = tf.Variable(probs)
-    argmax = tf.math.argmax(ts, axis=1)
+    '''
+    cdf = np.cumsum(probs, axis=1)
+    thresholds = np.random.random_sample((len(cdf), 1)) * cdf[:, -1:]
     
-    return argmax.numpy()
\ No newline at end of file
+    return np.argmax(cdf > thresholds, axis=1)
@@ -1,15 +1,28 @@
 # -*- coding: utf-8 -*-
 
+import os
+import json
 import numpy as np
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from numpy.lib.stride_tricks import sliding_window_view
 from collections import namedtuple
 
 Replay = namedtuple('Replay', ['state', 'action', 'reward', 'next_state', 'done'])
 
 class ReplayMemory(object):
     
+    #n-шаговые записи (add_transition), значения по умолчанию для
+    #наследников, которые не вызывают __init__ (SharedReplayMemory)
+    n_step = 1
+    gamma = 1.0
+    _n_step_pending = None
+    
     def __init__(self,
                  max_replay_num=10000, 
-                 min_replay_num=100):
+                 min_replay_num=100,
+                 n_step=1,
+                 gamma=0.99):
         '''
         Класс для реализации памяти хранения игр
 
@@ -19,6 +32,10 @@ class ReplayMemory(object):
             DESCRIPTION. The default is 10000.
         min_replay_num : TYPE, optional
             DESCRIPTION. The default is 100.
+        n_step : int, optional
+            Количество шагов в записях, собираемых add_transition. The default is 1.
+        gamma : float, optional
+            Дисконт для суммы наград n-шаговой записи. The default is 0.99.
 
         Returns
         -------
@@ -30,6 +47,82 @@ class ReplayMemory(object):
         self.min_replay_num = min_replay_num
         self.size = 0
         self.total_replays = 0
+        self.n_step = n_step
+        self.gamma = gamma
+    
+    def add_transition(self, replay):
+        '''
+        Добавить очередной переход эпизода (см. add_transition_batch)
+
+        '''
+        if self.n_step == 1:
+            self.add_replay(replay)
+            return
+        self.add_transition_batch({key: [replay[key]] for key in Replay._fields})
+    
+    def add_transition_batch(self, batch):
+        '''
+        Добавить переходы эпизодов в порядке игры. При n_step > 1 из них
+        собираются n-шаговые записи: награда - дисконтированная сумма
+        наград n переходов, next_state и done - от последнего из них.
+        Эпизод не пересекается: переходы перед концом эпизода (done)
+        дают записи из оставшихся шагов с done = True. Переходы, для
+        которых ещё не пришли следующие n - 1, ждут следующего вызова.
+
+        Parameters
+        ----------
+        batch : dict or list
+            Словарь массивов по полям записи или список кортежей
+            (state, action, reward, next_state, done).
+
+        Returns
+        -------
+        None.
+
+        '''
+        if not isinstance(batch, dict):
+            batch = dict(zip(Replay._fields, zip(*batch)))
+        if self.n_step == 1:
+            self.add_replay_batch(batch)
+            return
+        
+        pending = self._n_step_pending
+        if pending is not None:
+            batch = {key: list(pending[key]) + list(batch[key]) for key in Replay._fields}
+        
+        dones = np.asarray(batch['done'], dtype='bool')
+        rewards = np.asarray(batch['reward'], dtype='float64')
+        count = len(dones)
+        ids = np.arange(count)
+        
+        #последний переход записи: через n - 1 шагов или конец эпизода
+        #(count - эпизод ещё не закончен)
+        done_ids = np.where(dones, ids, count)
+        next_done = np.minimum.accumulate(done_ids[::-1])[::-1]
+        last = np.minimum(ids + self.n_step - 1, next_done)
+        #запись готова, если её последний переход уже пришёл,
+        #готовые записи - всегда начало батча
+        ready_num = int(np.sum(last < count))
+        
+        if ready_num > 0:
+            ids = ids[:ready_num]
+            last = last[:ready_num]
+            n_step_rewards = np.zeros(ready_num)
+            for k in range(self.n_step):
+                step_ids = np.minimum(ids + k, last)
+                n_step_rewards += np.where(ids + k <= last, self.gamma ** k * rewards[step_ids], 0)
+            
+            self.add_replay_batch({
+                'state': batch['state'][:ready_num],
+                'action': batch['action'][:ready_num],
+                'reward': n_step_rewards,
+                'next_state': [batch['next_state'][i] for i in last],
+                'done': dones[last]})
+        
+        if ready_num < count:
+            self._n_step_pending = {key: list(batch[key][ready_num:]) for key in Replay._fields}
+        else:
+            self._n_step_pending = None
         
     def add_replay_batch(self, batch):
         for i in range(len(batch['state'])):
@@ -82,6 +175,8 @@ class ReplayMemory(object):
         for key in self.memory.keys():
             self.memory[key].clear()
         self.size = 0
+        #незавершённые переходы n-шаговых записей относятся к старому эпизоду
+        self._n_step_pending = None
         
     def get_samples(self, start = 0, end = -1):
         '''
@@ -137,44 +232,891 @@ class ReplayMemory(object):
         
         return {'state': states, 'action':actions, 'reward': rewards, 'next_state': states_next, 'done': dones}
     
+    def pop_samples(self):
+        '''
+        Получить все записи и очистить память
+
+        Returns
+        -------
+        dict
+            DESCRIPTION.
+
+        '''
+        samples = self.get_samples()
+        self.clear()
+        
+        return samples
+
+class RingReplayMemory(ReplayMemory):
+
+    #типы массивов для каждого поля записи
+    dtypes = {'state': 'float32', 'action': 'int32', 'reward': 'float32', 'next_state': 'float32', 'done': 'bool'}
+
+    def __init__(self,
+                 max_replay_num=10000,
+                 min_replay_num=100,
+                 init_capacity=1024,
+                 n_step=1,
+                 gamma=0.99):
+        '''
+        Память игр на основе кольцевого буфера. Массивы numpy для каждого
+        поля выделяются заранее (форма определяется по первой записи), новая
+        запись перезаписывает самую старую по позиции курсора.
+
+        Parameters
+        ----------
+        max_replay_num : int, optional
+            Размер буфера. Если -1, то буфер расширяется по мере
+            заполнения. The default is 10000.
+        min_replay_num : int, optional
+            DESCRIPTION. The default is 100.
+        init_capacity : int, optional
+            Начальный размер буфера при max_replay_num = -1. The default is 1024.
+        n_step : int, optional
+            Количество шагов в записях, собираемых add_transition. The default is 1.
+        gamma : float, optional
+            Дисконт для суммы наград n-шаговой записи. The default is 0.99.
+
+        Returns
+        -------
+        None.
+
+        '''
+        super(RingReplayMemory, self).__init__(max_replay_num, min_replay_num, n_step, gamma)
+
+        self.memory = None
+        if max_replay_num == -1:
+            self.capacity = init_capacity
+        else:
+            self.capacity = max_replay_num
+        #позиция следующей записи
+        self.cursor = 0
+
+    def _allocate(self, replay, capacity):
+        '''
+        Выделить массивы под capacity записей с формой полей как у replay
+
+        '''
+        memory = {}
+        for key, dtype in self.dtypes.items():
+            shape = (capacity,) + np.shape(replay[key])
+            memory[key] = np.zeros(shape, dtype=dtype)
+
+        return memory
+
+    def _grow(self):
+        '''
+        Увеличить буфер в 2 раза с сохранением порядка записей
+
+        '''
+        ids = self._indices(np.arange(self.size))
+        capacity = self.capacity * 2
+
+        memory = {}
+        for key in self.memory.keys():
+            shape = (capacity,) + self.memory[key].shape[1:]
+            memory[key] = np.zeros(shape, dtype=self.memory[key].dtype)
+            memory[key][:self.size] = self.memory[key][ids]
+
+        self.memory = memory
+        self.capacity = capacity
+        self.cursor = self.size
+
+    def _indices(self, ids):
+        '''
+        Перевести порядковые номера записей (0 - самая старая) в позиции буфера
+
+        '''
+        return (self.cursor - self.size + ids) % self.capacity
+
+    def add_replay(self, replay):
+        '''
+        Добавить новую запись. Если буфер заполнен, то самая старая запись
+        будет перезаписана.
+
+        Parameters
+        ----------
+        replay : Replay
+            Кортеж состояния игры и результатов.
+
+        Returns
+        -------
+        None.
+
+        '''
+        if self.memory is None:
+            self.memory = self._allocate(replay, self.capacity)
+        elif self.size == self.capacity and self.max_replay_num == -1:
+            self._grow()
+        #
+        for key in self.memory.keys():
+            self.memory[key][self.cursor] = replay[key]
+        self.cursor = (self.cursor + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        #
+        self.total_replays += 1
+
+    def add_replay_batch(self, batch):
+        '''
+        Добавить набор записей за один вызов. Записи копируются в буфер
+        срезами с учётом перехода через конец буфера.
+
+        Parameters
+        ----------
+        batch : dict or list
+            Словарь массивов по полям записи или список кортежей
+            (state, action, reward, next_state, done).
+
+        Returns
+        -------
+        None.
+
+        '''
+        if not isinstance(batch, dict):
+            batch = dict(zip(self.dtypes.keys(), zip(*batch)))
+        n = len(batch['state'])
+        if n == 0:
+            return
+
+        if self.memory is None:
+            self.memory = self._allocate({key: batch[key][0] for key in self.dtypes.keys()}, self.capacity)
+        if self.max_replay_num == -1:
+            while self.size + n > self.capacity:
+                self._grow()
+
+        #если записей больше, чем размер буфера, остаются только последние
+        skip = max(0, n - self.capacity)
+        count = n - skip
+        first = min(count, self.capacity - self.cursor)
+
+        for key in self.memory.keys():
+            data = np.asarray(batch[key][skip:])
+            self.memory[key][self.cursor:self.cursor + first] = data[:first]
+            self.memory[key][:count - first] = data[first:]
+
+        self.cursor = (self.cursor + count) % self.capacity
+        self.size = min(self.size + count, self.capacity)
+        #
+        self.total_replays += n
+
+    def clear(self):
+        '''
+        Очистить память. Выделенные массивы сохраняются.
+
+        Returns
+        -------
+        None.
+
+        '''
+        self.cursor = 0
+        self.size = 0
+        #незавершённые переходы n-шаговых записей относятся к старому эпизоду
+        self._n_step_pending = None
+
+    def get_batch_buffers(self, batch_size):
+        '''
+        Выделить массивы под batch_size записей для повторного использования
+        в get_samples/get_random_samples (параметр out)
+
+        Parameters
+        ----------
+        batch_size : int
+            DESCRIPTION.
+
+        Returns
+        -------
+        dict
+            DESCRIPTION.
+
+        '''
+        return {key: np.empty((batch_size,) + self.memory[key].shape[1:], dtype=self.memory[key].dtype)
+                for key in self.dtypes.keys()}
+
+    def _take(self, ids, out=None):
+        '''
+        Выбрать записи по позициям буфера, по одному np.take на поле
+
+        '''
+        if out is None:
+            return {key: np.take(self.memory[key], ids, axis=0) for key in self.dtypes.keys()}
+
+        for key in self.dtypes.keys():
+            np.take(self.memory[key], ids, axis=0, out=out[key], mode='clip')
+        return out
+
+    def get_samples(self, start = 0, end = -1, out=None):
+        '''
+        Получить записи с start по end в порядке добавления
+
+        Parameters
+        ----------
+        start : int, optional
+            DESCRIPTION. The default is 0.
+        end : int, optional
+            DESCRIPTION. The default is -1.
+        out : dict, optional
+            Массивы для записи результата (см. get_batch_buffers).
+            The default is None.
+
+        Returns
+        -------
+        dict
+            DESCRIPTION.
+
+        '''
+        if self.memory is None:
+            return {key: np.asarray([]) for key in self.dtypes.keys()}
+        if end == -1:
+            end = self.size
+        ids = self._indices(np.arange(start, end))
+
+        return self._take(ids, out)
+
+    def get_random_samples(self, batch_size, out=None):
+        '''
+        Получить набор набор n случайных записей из памяти
+
+        Parameters
+        ----------
+        batch_size : int
+            DESCRIPTION.
+        out : dict, optional
+            Массивы для записи результата (см. get_batch_buffers).
+            The default is None.
+
+        Returns
+        -------
+        dict
+            DESCRIPTION.
+
+        '''
+        ids = self._indices(np.random.randint(low=0, high=self.size, size=batch_size))
+
+        return self._take(ids, out)
+
+class SumTree(object):
+
+    def __init__(self, capacity):
+        '''
+        Дерево сумм на массиве. Листья хранят приоритеты записей, каждый
+        внутренний узел - сумму своих потомков, tree[1] - сумма всех
+        приоритетов. Число листьев округляется вверх до степени 2, чтобы все
+        листья были на одной глубине.
+
+        Parameters
+        ----------
+        capacity : int
+            Количество приоритетов.
+
+        Returns
+        -------
+        None.
+
+        '''
+        self.capacity = capacity
+        self.depth = int(np.ceil(np.log2(max(capacity, 2))))
+        self.leaves = 2 ** self.depth
+        self.tree = np.zeros(2 * self.leaves, dtype='float64')
+
+    def total(self):
+        return self.tree[1]
+
+    def get(self, ids):
+        return self.tree[self.leaves + np.asarray(ids)]
+
+    def update(self, ids, priorities):
+        '''
+        Записать приоритеты в листья ids и пересчитать суммы на пути к корню
+
+        Parameters
+        ----------
+        ids : array
+            Позиции записей.
+        priorities : array
+            Новые приоритеты.
+
+        Returns
+        -------
+        None.
+
+        '''
+        nodes = self.leaves + np.asarray(ids)
+        self.tree[nodes] = priorities
+        for _ in range(self.depth):
+            nodes = np.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def find(self, values):
+        '''
+        Найти листья, в отрезки которых попадают значения values
+        (сумма приоритетов слева от листа <= value < сумма с листом)
+
+        Parameters
+        ----------
+        values : array
+            Значения из [0, total).
+
+        Returns
+        -------
+        array
+            Позиции записей.
+
+        '''
+        values = np.array(values, dtype='float64')
+        nodes = np.ones(len(values), dtype='int64')
+        for _ in range(self.depth):
+            left = 2 * nodes
+            go_right = values >= self.tree[left]
+            values = np.where(go_right, values - self.tree[left], values)
+            nodes = np.where(go_right, left + 1, left)
+
+        return np.minimum(nodes - self.leaves, self.capacity - 1)
+
+    def clear(self):
+        self.tree[:] = 0
+
+class PrioritizedReplayMemory(RingReplayMemory):
+
+    def __init__(self,
+                 max_replay_num=10000,
+                 min_replay_num=100,
+                 alpha=0.6,
+                 beta=0.4,
+                 beta_increment=0.0001,
+                 epsilon=1e-6,
+                 n_step=1,
+                 gamma=0.99):
+        '''
+        Память с приоритетной выборкой (Prioritized Experience Replay).
+        Вероятность выбора записи пропорциональна priority**alpha, где
+        priority - модуль TD ошибки. Новые записи получают максимальный
+        приоритет, чтобы быть выбранными хотя бы один раз.
+
+        Parameters
+        ----------
+        max_replay_num : int, optional
+            Размер буфера, -1 не поддерживается. The default is 10000.
+        min_replay_num : int, optional
+            DESCRIPTION. The default is 100.
+        alpha : float, optional
+            Степень приоритизации (0 - равномерная выборка). The default is 0.6.
+        beta : float, optional
+            Начальная степень коррекции весов выборки. The default is 0.4.
+        beta_increment : float, optional
+            Увеличение beta после каждой выборки (до 1). The default is 0.0001.
+        epsilon : float, optional
+            Добавка к TD ошибке, чтобы приоритет не был нулевым. The default is 1e-6.
+        n_step : int, optional
+            Количество шагов в записях, собираемых add_transition. The default is 1.
+        gamma : float, optional
+            Дисконт для суммы наград n-шаговой записи. The default is 0.99.
+
+        Returns
+        -------
+        None.
+
+        '''
+        if max_replay_num == -1:
+            raise ValueError('PrioritizedReplayMemory requires max_replay_num != -1')
+
+        super(PrioritizedReplayMemory, self).__init__(max_replay_num, min_replay_num, n_step=n_step, gamma=gamma)
+
+        self.alpha = alpha
+        self.beta = beta
+        self.beta_increment = beta_increment
+        self.epsilon = epsilon
+        self.max_priority = 1.0
+        self.tree = SumTree(self.capacity)
+
+    def _set_new_priorities(self, count):
+        #последние count записей получают максимальный приоритет
+        ids = self._indices(np.arange(self.size - count, self.size))
+        self.tree.update(ids, np.full(count, self.max_priority ** self.alpha))
+
+    def add_replay(self, replay):
+        super(PrioritizedReplayMemory, self).add_replay(replay)
+        self._set_new_priorities(1)
+
+    def add_replay_batch(self, batch):
+        total_replays = self.total_replays
+        super(PrioritizedReplayMemory, self).add_replay_batch(batch)
+        self._set_new_priorities(min(self.total_replays - total_replays, self.capacity))
+
+    def clear(self):
+        super(PrioritizedReplayMemory, self).clear()
+        self.tree.clear()
+        self.max_priority = 1.0
+
+    def get_random_samples(self, batch_size, out=None):
+        '''
+        Получить batch_size записей пропорционально приоритетам. Помимо полей
+        записи возвращаются 'index' - позиции записей для update_priorities и
+        'weight' - веса importance sampling для функции потерь.
+
+        Parameters
+        ----------
+        batch_size : int
+            DESCRIPTION.
+        out : dict, optional
+            Массивы для записи результата (см. get_batch_buffers).
+            The default is None.
+
+        Returns
+        -------
+        dict
+            DESCRIPTION.
+
+        '''
+        #стратифицированная выборка: по одному значению из каждого отрезка,
+        #отрезки перемешаны, чтобы любая часть батча покрывала всю память
+        segment = self.tree.total() / batch_size
+        values = (np.random.permutation(batch_size) + np.random.random(batch_size)) * segment
+        ids = self.tree.find(values)
+
+        probs = self.tree.get(ids) / self.tree.total()
+        weights = np.power(self.size * probs, -self.beta)
+        weights /= np.max(weights)
+        self.beta = min(1.0, self.beta + self.beta_increment)
+
+        samples = self._take(ids, out)
+        samples['weight'] = weights.astype('float32')
+        samples['index'] = ids
+
+        return samples
+
+    def update_priorities(self, ids, td_errors):
+        '''
+        Обновить приоритеты выбранных записей по TD ошибкам
+
+        Parameters
+        ----------
+        ids : array
+            Позиции записей ('index' из get_random_samples).
+        td_errors : array
+            TD ошибки записей.
+
+        Returns
+        -------
+        None.
+
+        '''
+        priorities = np.abs(td_errors) + self.epsilon
+        self.max_priority = max(self.max_priority, np.max(priorities))
+        self.tree.update(ids, np.power(priorities, self.alpha))
+
+class MemmapReplayMemory(RingReplayMemory):
+
+    def __init__(self,
+                 path,
+                 max_replay_num=10000,
+                 min_replay_num=100,
+                 mode='r+',
+                 flush_every=1000,
+                 n_step=1,
+                 gamma=0.99):
+        '''
+        Кольцевой буфер, хранящийся на диске в файлах numpy.memmap (один файл
+        на поле записи). Положение курсора и размер буфера сохраняются в
+        meta.json при каждом сбросе на диск, поэтому после падения процесса
+        буфер можно открыть заново без повторного сбора игр.
+
+        Parameters
+        ----------
+        path : str
+            Каталог для файлов буфера.
+        max_replay_num : int, optional
+            Размер буфера, -1 не поддерживается. Для существующего буфера
+            берётся из meta.json. The default is 10000.
+        min_replay_num : int, optional
+            DESCRIPTION. The default is 100.
+        mode : str, optional
+            'r+' - открыть существующий буфер или создать новый,
+            'w+' - всегда создать новый,
+            'r' - открыть существующий только для чтения (для других процессов).
+            The default is 'r+'.
+        flush_every : int, optional
+            Сбрасывать буфер на диск каждые flush_every записей.
+            The default is 1000.
+        n_step : int, optional
+            Количество шагов в записях, собираемых add_transition. The default is 1.
+        gamma : float, optional
+            Дисконт для суммы наград n-шаговой записи. The default is 0.99.
+
+        Returns
+        -------
+        None.
+
+        '''
+        if max_replay_num == -1:
+            raise ValueError('MemmapReplayMemory requires max_replay_num != -1')
+
+        super(MemmapReplayMemory, self).__init__(max_replay_num, min_replay_num, n_step=n_step, gamma=gamma)
+
+        self.path = path
+        self.mode = mode
+        self.flush_every = flush_every
+
+        if mode == 'r' or (mode == 'r+' and os.path.exists(self._meta_path())):
+            self.refresh()
+        elif not os.path.exists(path):
+            os.makedirs(path)
+
+    def _meta_path(self):
+        return os.path.join(self.path, 'meta.json')
+
+    def _field_path(self, key):
+        return os.path.join(self.path, key + '.dat')
+
+    def _allocate(self, replay, capacity):
+        '''
+        Создать файлы под capacity записей с формой полей как у replay
+
+        '''
+        if self.mode == 'r':
+            raise ValueError('MemmapReplayMemory opened in read-only mode')
+
+        memory = {}
+        for key, dtype in self.dtypes.items():
+            shape = (capacity,) + np.shape(replay[key])
+            memory[key] = np.memmap(self._field_path(key), dtype=dtype, mode='w+', shape=shape)
+
+        return memory
+
+    def refresh(self):
+        '''
+        Прочитать meta.json и открыть файлы буфера. Процесс-читатель вызывает
+        этот метод, чтобы увидеть записи, добавленные другим процессом.
+
+        Returns
+        -------
+        None.
+
+        '''
+        with open(self._meta_path()) as f:
+            meta = json.load(f)
+
+        if self.memory is None or self.capacity != meta['capacity']:
+            mode = 'r' if self.mode == 'r' else 'r+'
+            self.memory = {}
+            for key, dtype in self.dtypes.items():
+                shape = (meta['capacity'],) + tuple(meta['shapes'][key])
+                self.memory[key] = np.memmap(self._field_path(key), dtype=dtype, mode=mode, shape=shape)
+
+        self.capacity = meta['capacity']
+        self.max_replay_num = meta['capacity']
+        self.cursor = meta['cursor']
+        self.size = meta['size']
+        self.total_replays = meta['total_replays']
+
+    def flush(self):
+        '''
+        Сбросить данные на диск и сохранить meta.json. Метаданные пишутся
+        после данных через временный файл, поэтому meta.json всегда
+        описывает записанные строки.
+
+        Returns
+        -------
+        None.
+
+        '''
+        if self.memory is None or self.mode == 'r':
+            return
+
+        for key in self.memory.keys():
+            self.memory[key].flush()
+
+        meta = {
+            'capacity': self.capacity,
+            'cursor': self.cursor,
+            'size': self.size,
+            'total_replays': self.total_replays,
+            'shapes': {key: list(self.memory[key].shape[1:]) for key in self.memory.keys()}
+            }
+        tmp_path = self._meta_path() + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self._meta_path())
+
+    def add_replay(self, replay):
+        super(MemmapReplayMemory, self).add_replay(replay)
+        if self.total_replays % self.flush_every == 0:
+            self.flush()
+
+    def add_replay_batch(self, batch):
+        total_replays = self.total_replays
+        super(MemmapReplayMemory, self).add_replay_batch(batch)
+        #сброс, если батч перешёл через границу flush_every записей
+        if self.total_replays // self.flush_every > total_replays // self.flush_every:
+            self.flush()
+
+    def clear(self):
+        super(MemmapReplayMemory, self).clear()
+        self.flush()
+
+class SharedReplayMemory(RingReplayMemory):
+
+    def __init__(self,
+                 state_shape,
+                 max_replay_num=10000,
+                 min_replay_num=100,
+                 lock=None):
+        '''
+        Кольцевой буфер в разделяемой памяти (multiprocessing.shared_memory)
+        для сбора игр несколькими процессами. Курсор, размер и счётчик
+        записей хранятся в общем заголовке и меняются под общей блокировкой,
+        поэтому процессы-сборщики могут добавлять записи одновременно, а
+        ученик читает их без передачи траекторий через очередь.
+
+        Объект передаётся в другие процессы как аргумент Process (или в
+        shared_memory агента): при распаковке он подключается к тем же
+        сегментам. Сегменты удаляет создавший их процесс методом unlink.
+
+        Parameters
+        ----------
+        state_shape : list
+            Форма состояния, сегменты выделяются сразу.
+        max_replay_num : int, optional
+            Размер буфера, -1 не поддерживается. The default is 10000.
+        min_replay_num : int, optional
+            DESCRIPTION. The default is 100.
+        lock : multiprocessing.Lock, optional
+            Блокировка записи. The default is None - создаётся новая
+            (контекст spawn, как у ActorPool).
+
+        Returns
+        -------
+        None.
+
+        '''
+        if max_replay_num == -1:
+            raise ValueError('SharedReplayMemory requires max_replay_num != -1')
+
+        #super().__init__ не вызывается: cursor, size и total_replays
+        #хранятся в заголовке и не должны сбрасываться при подключении
+        self.max_replay_num = max_replay_num
+        self.min_replay_num = min_replay_num
+        self.capacity = max_replay_num
+        self.state_shape = tuple(state_shape)
+        self.lock = lock if lock is not None else mp.get_context('spawn').Lock()
+        self.owner = True
+
+        shapes = self._shapes()
+        self._segments = {}
+        for key, dtype in self.dtypes.items():
+            nbytes = max(1, int(np.prod(shapes[key])) * np.dtype(dtype).itemsize)
+            self._segments[key] = shared_memory.SharedMemory(create=True, size=nbytes)
+        self._segments['header'] = shared_memory.SharedMemory(create=True, size=3 * 8)
+        self._attach()
+        self._header[:] = 0
+
+    def _shapes(self):
+
+        shapes = {key: (self.capacity,) for key in self.dtypes.keys()}
+        shapes['state'] = (self.capacity,) + self.state_shape
+        shapes['next_state'] = (self.capacity,) + self.state_shape
+
+        return shapes
+
+    def _attach(self):
+        '''
+        Массивы numpy поверх сегментов разделяемой памяти
+
+        '''
+        shapes = self._shapes()
+        self.memory = {key: np.ndarray(shapes[key], dtype=dtype, buffer=self._segments[key].buf)
+                       for key, dtype in self.dtypes.items()}
+        #[cursor, size, total_replays]
+        self._header = np.ndarray((3,), dtype='int64', buffer=self._segments['header'].buf)
+
+    def __getstate__(self):
+        return {
+            'max_replay_num': self.max_replay_num,
+            'min_replay_num': self.min_replay_num,
+            'state_shape': self.state_shape,
+            'lock': self.lock,
+            'names': {key: segment.name for key, segment in self._segments.items()}
+            }
+
+    def __setstate__(self, state):
+        self.max_replay_num = state['max_replay_num']
+        self.min_replay_num = state['min_replay_num']
+        self.capacity = state['max_replay_num']
+        self.state_shape = state['state_shape']
+        self.lock = state['lock']
+        self.owner = False
+        self._segments = {key: shared_memory.SharedMemory(name=name) for key, name in state['names'].items()}
+        self._attach()
+
+    @property
+    def cursor(self):
+        return int(self._header[0])
+
+    @cursor.setter
+    def cursor(self, value):
+        self._header[0] = value
+
+    @property
+    def size(self):
+        return int(self._header[1])
+
+    @size.setter
+    def size(self, value):
+        self._header[1] = value
+
+    @property
+    def total_replays(self):
+        return int(self._header[2])
+
+    @total_replays.setter
+    def total_replays(self, value):
+        self._header[2] = value
+
+    def add_replay(self, replay):
+        with self.lock:
+            super(SharedReplayMemory, self).add_replay(replay)
+
+    def add_replay_batch(self, batch):
+        with self.lock:
+            super(SharedReplayMemory, self).add_replay_batch(batch)
+
+    def clear(self):
+        with self.lock:
+            super(SharedReplayMemory, self).clear()
+
+    def get_samples(self, start = 0, end = -1, out=None):
+        with self.lock:
+            return super(SharedReplayMemory, self).get_samples(start, end, out)
+
+    def get_random_samples(self, batch_size, out=None):
+        with self.lock:
+            return super(SharedReplayMemory, self).get_random_samples(batch_size, out)
+
+    def pop_samples(self):
+        '''
+        Получить все записи и очистить память под одной блокировкой:
+        записи, добавленные сборщиками во время обучения, не теряются.
+
+        '''
+        with self.lock:
+            samples = RingReplayMemory.get_samples(self)
+            RingReplayMemory.clear(self)
+
+        return samples
+
+    def close(self):
+        '''
+        Отключиться от сегментов разделяемой памяти
+
+        '''
+        self.memory = None
+        self._header = None
+        for segment in self._segments.values():
+            segment.close()
+
+    def unlink(self):
+        '''
+        Отключиться и удалить сегменты (только в создавшем их процессе)
+
+        '''
+        self.close()
+        if self.owner:
+            for segment in self._segments.values():
+                segment.unlink()
+
 class LSTMemory(object):
     
     def __init__(self, timesteps, data_shape):
+        '''
+        История последних timesteps состояний для LSTM. Хранится в
+        кольцевом буфере float32 удвоенной длины: каждая запись пишется в
+        позиции cursor и cursor + timesteps, поэтому окно от старой записи к
+        новой всегда является непрерывным срезом буфера и читается без
+        копирования.
+
+        Parameters
+        ----------
+        timesteps : int
+            Длина истории.
+        data_shape : tuple
+            Форма одного состояния.
+
+        Returns
+        -------
+        None.
+
+        '''
         self.timesteps = timesteps
         self.data_shape = data_shape
-        self.lstm_data = []
-        self.reset()
+        self.lstm_data = np.zeros((2 * timesteps,) + data_shape, dtype='float32')
+        self.cursor = 0
         
     def add_data(self, data):
-        assert np.shape(data) == self.data_shape
-        self.lstm_data.pop(0)
-        self.lstm_data.append(data)
+        self.lstm_data[self.cursor] = data
+        self.lstm_data[self.cursor + self.timesteps] = data
+        self.cursor = (self.cursor + 1) % self.timesteps
         
     def size(self):
-        return len(self.lstm_data)
+        return self.timesteps
+    
+    def get_view(self):
+        #окно (timesteps,) + data_shape без копирования
+        return self.lstm_data[self.cursor:self.cursor + self.timesteps]
+    
+    def get_batch(self):
+        #окно в виде батча из одного элемента без копирования
+        return self.get_view()[np.newaxis]
     
     def get_data(self):
-        return np.copy(self.lstm_data)
+        return np.copy(self.get_view())
         
     def reset(self):
-        self.lstm_data = [np.zeros(self.data_shape) for i in range(self.timesteps)]
+        self.lstm_data[:] = 0
+        self.cursor = 0
       
     def split_to_timesteps(self, data, resets = None):
-        assert len(data) == len(resets) or resets is None
+        '''
+        Разбить последовательность на окна длины timesteps для LSTM.
+        Окно i содержит записи data[i-timesteps+1..i] текущего эпизода,
+        недостающие записи (начало данных или эпизода) заполнены нулями.
+        Окна строятся одним проходом через sliding_window_view по данным с
+        нулевым дополнением, границы эпизодов применяются маской.
+
+        Parameters
+        ----------
+        data : array
+            Последовательность записей формы (N,) + data_shape.
+        resets : array, optional
+            Признак конца эпизода для каждой записи. The default is None.
+
+        Returns
+        -------
+        array
+            Окна формы (N, timesteps) + data_shape.
+
+        '''
+        assert resets is None or len(data) == len(resets)
         
-        self.reset()
-        batches = []
+        data = np.asarray(data, dtype='float32').reshape((-1,) + self.data_shape)
+        n = len(data)
+        if n == 0:
+            return np.zeros((0, self.timesteps) + self.data_shape, dtype='float32')
         
-        for i in range(len(data)):
-            
-            self.add_data(data[i])
-            batches.append(self.get_data())
-            
-            if resets is not None:
-                if resets[i]:
-                    self.reset()
-                
-        self.reset()
-        
-        return np.asarray(batches)
-        self.lstm_data = [np.zeros(self.data_shape) for i in range(self.timesteps)]
+        padding = np.zeros((self.timesteps - 1,) + self.data_shape, dtype='float32')
+        padded = np.concatenate([padding, data])
+        #(N, data_shape..., timesteps) -> (N, timesteps, data_shape...)
+        windows = np.moveaxis(sliding_window_view(padded, self.timesteps, axis=0), -1, 1)
+        
+        if resets is None:
+            return np.ascontiguousarray(windows)
+        
+        #начало эпизода для каждой записи: позиция после последнего reset
+        starts = np.zeros(n, dtype='int64')
+        starts[1:] = np.where(np.asarray(resets[:-1], dtype='bool'), np.arange(1, n), 0)
+        starts = np.maximum.accumulate(starts)
+        
+        #номер записи в каждой позиции окна
+        positions = np.arange(n)[:, None] - (self.timesteps - 1) + np.arange(self.timesteps)[None, :]
+        mask = positions >= starts[:, None]
+        mask = mask.reshape(mask.shape + (1,) * len(self.data_shape))
+        
+        return windows * mask
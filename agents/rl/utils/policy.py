@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import tensorflow as tf
+
+def legal_actions_mask(legal_actions, num_actions):
+    '''
+    Маска допустимых действий для батча состояний
+
+    Parameters
+    ----------
+    legal_actions : list
+        Список допустимых действий для каждого состояния батча.
+    num_actions : int
+        DESCRIPTION.
+
+    Returns
+    -------
+    mask : array
+        Массив bool (batch, num_actions), True - действие допустимо.
+
+    '''
+    mask = np.zeros((len(legal_actions), num_actions), dtype='bool')
+    for row, actions in enumerate(legal_actions):
+        mask[row, actions] = True
+
+    return mask
+
+def additive_mask(mask):
+    '''
+    Аддитивная маска из булевой: 0 для допустимых действий, -inf для
+    недопустимых
+
+    '''
+    mask = tf.convert_to_tensor(mask)
+
+    return tf.where(mask, 0., -np.inf)
+
+def masked_logits(logits, mask):
+    '''
+    Маскирование логитов: недопустимые действия получают -inf, так что
+    после softmax их вероятность точно 0, а нормировка по допустимым
+    действиям не теряет точность. Строки, в которых нет ни одного
+    допустимого действия, остаются без маски.
+
+    Только операции tensorflow, поэтому функция работает внутри tf.function.
+
+    Parameters
+    ----------
+    logits : tensor
+        Логиты, форма (batch, num_actions).
+    mask : tensor
+        Булева маска (True - действие допустимо) или аддитивная
+        (0 - допустимо, -inf - недопустимо), той же формы или
+        (num_actions,) для всего батча.
+
+    Returns
+    -------
+    logits : tensor
+        DESCRIPTION.
+
+    '''
+    logits = tf.convert_to_tensor(logits, dtype=tf.float32)
+    mask = tf.convert_to_tensor(mask)
+
+    if mask.dtype == tf.bool:
+        legal = tf.broadcast_to(mask, tf.shape(logits))
+        masked = tf.where(legal, logits, -np.inf)
+    else:
+        mask = tf.cast(mask, logits.dtype)
+        legal = tf.broadcast_to(mask > -np.inf, tf.shape(logits))
+        masked = logits + mask
+
+    #все действия недопустимы - маска игнорируется
+    any_legal = tf.reduce_any(legal, axis=1, keepdims=True)
+
+    return tf.where(any_legal, masked, logits)
+
+def masked_softmax(logits, mask):
+    '''
+    Вероятности действий с учётом маски (см. masked_logits)
+
+    '''
+    return tf.nn.softmax(masked_logits(logits, mask), axis=1)
+
+def masked_argmax(logits, mask):
+    '''
+    Лучшее допустимое действие для каждой строки (см. masked_logits)
+
+    '''
+    return tf.math.argmax(masked_logits(logits, mask), axis=1)
+
+def softmax(logits, legal_actions):
+    '''
+    masked_softmax для списков допустимых действий, результат - массив
+    numpy (batch, num_actions)
+
+    Parameters
+    ----------
+    logits : tensor
+        DESCRIPTION.
+    legal_actions : list
+        Список допустимых действий для каждой строки логитов.
+
+    Returns
+    -------
+    probs : array
+        DESCRIPTION.
+
+    '''
+    mask = legal_actions_mask(legal_actions, logits.shape[1])
+
+    return masked_softmax(logits, mask).numpy()
+
+def argmax(logits, legal_actions):
+    '''
+    masked_argmax для списков допустимых действий, результат - массив
+    numpy (batch,)
+
+    '''
+    mask = legal_actions_mask(legal_actions, logits.shape[1])
+
+    return masked_argmax(logits, mask).numpy()
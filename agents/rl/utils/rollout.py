@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+from rlcard.utils import reorganize
+
+class BatchedRollout(object):
+    '''
+    Одновременная игра на нескольких столах rlcard. Столы продвигаются
+    синхронно: на каждом шаге решения, ожидающие одного и того же агента,
+    собираются в один вызов agent.batch_step (agent.batch_eval_step при
+    оценке), так что проход сети делится между столами. Агенты без
+    пакетных методов (RandomAgent, DDQNAgent, ...) ходят по одному
+    состоянию через step/eval_step.
+
+    Агенты с lstm получают место (стол, игрок), история каждого места
+    сбрасывается в начале партии.
+    '''
+
+    def __init__(self, envs):
+        '''
+        Parameters
+        ----------
+        envs : list
+            Среды rlcard с уже заданными агентами (env.set_agents).
+
+        Returns
+        -------
+        None.
+
+        '''
+        self.envs = envs
+
+    def run(self, is_training=False, episode_num=None):
+        '''
+        Сыграть episode_num партий. Освободившийся стол сразу начинает
+        следующую партию, пока не набрано нужное количество.
+
+        Parameters
+        ----------
+        is_training : bool, optional
+            Использовать step (True) или eval_step (False). The default is False.
+        episode_num : int, optional
+            Количество партий. The default is None - по одной на стол.
+
+        Returns
+        -------
+        trajectories : list
+            Траектории партий в порядке завершения, для каждой партии -
+            список траекторий игроков, как в env.run.
+        payoffs : list
+            Выигрыши игроков для каждой партии.
+        table_ids : list
+            Номер стола (индекс в envs) для каждой партии.
+
+        '''
+        if episode_num is None:
+            episode_num = len(self.envs)
+
+        trajectories = []
+        payoffs = []
+        table_ids = []
+
+        #стол -> [траектории игроков, текущее состояние, текущий игрок]
+        tables = {}
+        started = 0
+        for table_id in range(len(self.envs)):
+            if started == episode_num:
+                break
+            tables[table_id] = self._reset(table_id)
+            started += 1
+
+        while len(tables) > 0:
+
+            #ожидающие решения, сгруппированные по агенту
+            groups = {}
+            for table_id, (_, state, player_id) in tables.items():
+                agent = self.envs[table_id].agents[player_id]
+                groups.setdefault(id(agent), (agent, []))[1].append(table_id)
+
+            for agent, group in groups.values():
+                states = [tables[table_id][1] for table_id in group]
+                seats = [(table_id, tables[table_id][2]) for table_id in group]
+                actions = self._act(agent, states, seats, is_training)
+
+                for table_id, action in zip(group, actions):
+                    if not self._step(tables, table_id, action):
+                        continue
+
+                    #партия закончена
+                    table_trajectories, table_payoffs = self._finish(tables.pop(table_id), table_id)
+                    trajectories.append(table_trajectories)
+                    payoffs.append(table_payoffs)
+                    table_ids.append(table_id)
+
+                    if started < episode_num:
+                        tables[table_id] = self._reset(table_id)
+                        started += 1
+
+        return trajectories, payoffs, table_ids
+
+    def _reset(self, table_id):
+
+        env = self.envs[table_id]
+        state, player_id = env.reset()
+
+        for seat_id, agent in enumerate(env.agents):
+            if hasattr(agent, 'batch_step') and hasattr(agent, 'reset_lstm_memory'):
+                agent.reset_lstm_memory((table_id, seat_id))
+
+        table_trajectories = [[] for _ in range(env.player_num)]
+        table_trajectories[player_id].append(state)
+
+        return [table_trajectories, state, player_id]
+
+    def _act(self, agent, states, seats, is_training):
+
+        if is_training:
+            if hasattr(agent, 'batch_step'):
+                return agent.batch_step(states, seats)
+            return [agent.step(state) for state in states]
+
+        if hasattr(agent, 'batch_eval_step'):
+            actions, _ = agent.batch_eval_step(states, seats)
+            return actions
+        return [agent.eval_step(state)[0] for state in states]
+
+    def _step(self, tables, table_id, action):
+        '''
+        Ход на столе table_id. Возвращает True, если партия закончилась.
+
+        '''
+        env = self.envs[table_id]
+        table_trajectories, _, player_id = tables[table_id]
+
+        next_state, next_player_id = env.step(action, env.agents[player_id].use_raw)
+        table_trajectories[player_id].append(action)
+
+        if env.is_over():
+            return True
+
+        table_trajectories[next_player_id].append(next_state)
+        tables[table_id] = [table_trajectories, next_state, next_player_id]
+
+        return False
+
+    def _finish(self, table, table_id):
+
+        env = self.envs[table_id]
+        table_trajectories = table[0]
+
+        for player_id in range(env.player_num):
+            table_trajectories[player_id].append(env.get_state(player_id))
+
+        table_payoffs = env.get_payoffs()
+
+        return reorganize(table_trajectories, table_payoffs), table_payoffs
@@ -8,6 +8,7 @@ import os
 import math
 import sys
 import argparse
+import functools
 from pprint import pprint
 
 import rlcard
@@ -21,6 +22,7 @@ from agents.A2CQPGAgent import A2CQPGAgent
 from agents.A2CLSTMAgent import A2CLSTMAgent
 from agents.A2CLSTMQPGAgent import A2CLSTMQPGAgent
 from agents.testAgents import FoldAgent
+from agents.rl.utils.evaluation import parallel_tournament
 
 def createParser():
     parser = argparse.ArgumentParser()
@@ -34,6 +36,9 @@ def createParser():
     parser.add_argument('-lm0', '--load_model0', default = None)
     parser.add_argument('-lm1', '--load_model1', default = None)
     
+    parser.add_argument('-wn', '--workers_num', default = None, type=int)
+    parser.add_argument('-tbn', '--tables_num', default = 16, type=int)
+    
     return  parser
 
 def getAgent(agent_type, env):
@@ -163,31 +168,19 @@ def main():
     # Set the iterations numbers and how frequently we evaluate/save plot
     evaluate_num = namespace.evaluate_num
     
-    # Make environment
-    eval_env = rlcard.make(env_name, config={'seed': random_seed})
-    
-    # Set a global seed
-    set_global_seed(random_seed)
-    
-    # Initialize a global step
-    global_step = tf.Variable(0, name='global_step', trainable=False)
-    
-    # Set up the agents
-    agent0 = getAgent(namespace.agent_type0, eval_env) 
-    agent1 = getAgent(namespace.agent_type1, eval_env)
-    
-    
-    if namespace.load_model0 is not None:
-        agent0.load_model(namespace.load_model0)
-    if namespace.load_model1 is not None:
-        agent1.load_model(namespace.load_model1)
-    
-  
-    eval_env.set_agents([agent0, agent1])
-
-    # Evaluate the performance. Play with random agents.
-    rewards = tournament(eval_env, evaluate_num)
-    print('Average reward for agent0 against agent1: ', rewards[0])
+    # Evaluate the performance. Hands are split between worker processes,
+    # each one creates the agents and loads the models itself and plays
+    # several tables with batched eval steps
+    rewards, intervals = parallel_tournament(
+        env_name,
+        [functools.partial(getAgent, namespace.agent_type0), 
+         functools.partial(getAgent, namespace.agent_type1)],
+        evaluate_num,
+        model_paths=[namespace.load_model0, namespace.load_model1],
+        workers_num=namespace.workers_num,
+        tables_num=namespace.tables_num,
+        seed=random_seed)
+    print('Average reward for agent0 against agent1: ', rewards[0], '+-', intervals[0])
         
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+
+from agents.rl.a2c_v2_lstm import A2CLSTM
+from agents.rl.a2c_v2_lstm_qpg import A2CLSTMQPG
+
+NUM_STATE_PARAMS = 6
+NUM_ACTIONS = 3
+
+def make_bot(bot_class, timesteps):
+
+    return bot_class(NUM_STATE_PARAMS, NUM_ACTIONS, timesteps=timesteps,
+                     critic_lstm_units=[8], critic_hidden_units=[8],
+                     actor_lstm_units=[8], actor_hidden_units=[8])
+
+def feed_episodes(bot, count, seed):
+    '''
+    count переходов случайных эпизодов длины от 1 до 4
+
+    '''
+    rng = np.random.default_rng(seed)
+    dones = rng.random(count) < 0.3
+    dones[-1] = True
+    bot.feed_batch({
+        'state': rng.normal(size=(count, NUM_STATE_PARAMS)).astype('float32'),
+        'action': rng.integers(NUM_ACTIONS, size=count),
+        'reward': rng.normal(size=count).astype('float32'),
+        'next_state': rng.normal(size=(count, NUM_STATE_PARAMS)).astype('float32'),
+        'done': dones})
+
+#(число записей, размер минибатча критика, размер минибатча актёра)
+TRAIN_SIZES = [(10, 4, 3), (17, 8, 5), (5, 16, 16), (33, 7, 2)]
+
+@pytest.mark.parametrize('bot_class', [A2CLSTM, A2CLSTMQPG])
+@pytest.mark.parametrize('timesteps', [1, 3])
+def test_train_does_not_retrace(bot_class, timesteps):
+
+    bot = make_bot(bot_class, timesteps)
+
+    feed_episodes(bot, 12, 0)
+    bot.train()
+    trace_counts = dict(bot.trace_counts)
+    assert trace_counts['critic'] > 0 and trace_counts['actor'] > 0
+
+    #другие размеры батча и последнего (неполного) минибатча
+    for seed, (count, critic_bacth_size, actor_bacth_size) in enumerate(TRAIN_SIZES):
+        bot.critic_bacth_size = critic_bacth_size
+        bot.actor_bacth_size = actor_bacth_size
+        feed_episodes(bot, count, seed + 1)
+        bot.train()
+
+    assert bot.trace_counts == trace_counts
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+
+from agents.rl.ddqn import DDQN
+from agents.DDQNAgent import DDQNAgent
+
+NUM_STATE_PARAMS = 4
+NUM_ACTIONS = 3
+
+def make_ddqn(**kwargs):
+
+    params = dict(hidden_units=[8], min_replay_num=1, batch_size=4, learning_rate=0.01,
+                  kernel_initializer='glorot_uniform')
+    params.update(kwargs)
+
+    return DDQN(NUM_STATE_PARAMS, NUM_ACTIONS, **params)
+
+def make_batch(steps, batch_size, seed):
+    '''
+    Случайные записи для _train_steps, первая размерность - номер шага
+
+    '''
+    rng = np.random.default_rng(seed)
+    shape = (steps, batch_size)
+
+    return (rng.normal(size=shape + (NUM_STATE_PARAMS,)).astype('float32'),
+            rng.integers(NUM_ACTIONS, size=shape).astype('int32'),
+            rng.normal(size=shape).astype('float32'),
+            rng.normal(size=shape + (NUM_STATE_PARAMS,)).astype('float32'),
+            rng.random(shape) < 0.3,
+            np.ones(shape, dtype='float32'))
+
+def feed_transitions(ddqn, count, seed):
+
+    states, actions, rewards, states_next, dones, _ = make_batch(1, count, seed)
+    ddqn.feed_batch(list(zip(states[0], actions[0], rewards[0], states_next[0], dones[0])))
+
+def get_weights(model):
+
+    return [v.numpy() for v in model.trainable_variables]
+
+def assert_weights_close(weights1, weights2):
+
+    for w1, w2 in zip(weights1, weights2):
+        np.testing.assert_allclose(w1, w2, rtol=1e-5, atol=1e-6)
+
+@pytest.mark.parametrize('n_step', [1, 3])
+def test_double_q_target(n_step):
+
+    ddqn = make_ddqn(gamma=0.9, n_step=n_step, update_target_net_every=None)
+    states, actions, rewards, states_next, dones, weights = make_batch(1, 8, 0)
+
+    #действие выбирает q_net, оценивает target_net
+    next_actions = np.argmax(ddqn.q_net(states_next[0]).numpy(), axis=1)
+    value_next = ddqn.target_net(states_next[0]).numpy()[np.arange(8), next_actions]
+    target_values = np.where(dones[0], rewards[0], rewards[0] + 0.9 ** n_step * value_next)
+    predicted_values = ddqn.q_net(states[0]).numpy()[np.arange(8), actions[0]]
+
+    _, td_errors = ddqn._train_steps(states, actions, rewards, states_next, dones, weights, 0)
+
+    np.testing.assert_allclose(td_errors.numpy()[0], target_values - predicted_values, rtol=1e-5, atol=1e-5)
+
+def test_hard_target_update_in_graph():
+
+    ddqn = make_ddqn(update_target_net_every=3)
+    target_weights = get_weights(ddqn.target_net)
+
+    #шаги 1 и 2 - target-nn не меняется
+    ddqn._train_steps(*make_batch(2, 4, 0), 0)
+    assert_weights_close(get_weights(ddqn.target_net), target_weights)
+    assert not np.allclose(get_weights(ddqn.q_net)[0], target_weights[0])
+
+    #шаг 3 (номер считается от train_step) - копия q_net
+    ddqn._train_steps(*make_batch(1, 4, 1), 2)
+    assert_weights_close(get_weights(ddqn.target_net), get_weights(ddqn.q_net))
+
+    #копия делается после шага 3 из 4, а не в конце вызова
+    ddqn1 = make_ddqn(update_target_net_every=3)
+    ddqn2 = make_ddqn(update_target_net_every=3)
+    ddqn2.q_net.set_weights(ddqn1.q_net.get_weights())
+    ddqn2.target_net.set_weights(ddqn1.target_net.get_weights())
+    batch = make_batch(4, 4, 2)
+
+    ddqn1._train_steps(*[value[:3] for value in batch], 0)
+    ddqn2._train_steps(*batch, 0)
+
+    assert_weights_close(get_weights(ddqn2.target_net), get_weights(ddqn1.q_net))
+    assert not np.allclose(get_weights(ddqn2.q_net)[0], get_weights(ddqn2.target_net)[0])
+
+def test_train_does_not_retrace():
+
+    ddqn = make_ddqn()
+    feed_transitions(ddqn, 64, 0)
+
+    ddqn.train()
+    trace_counts = dict(ddqn.trace_counts)
+
+    for steps, batch_size in [(1, 4), (5, 4), (2, 16), (1, 7), (8, 3)]:
+        ddqn.train(steps, batch_size=batch_size)
+
+    assert ddqn.trace_counts == trace_counts
+    assert ddqn.train_step == 1 + 1 + 5 + 2 + 1 + 8
+
+def test_train_before_min_replay_num():
+
+    ddqn = make_ddqn(min_replay_num=10)
+    feed_transitions(ddqn, 5, 0)
+
+    assert ddqn.train(3) == 0
+    assert ddqn.train_step == 0
+
+def test_agent_counts_only_trained_steps():
+
+    agent = DDQNAgent(replay_memory_init_size=10, batch_size=4, action_num=NUM_ACTIONS,
+                      state_shape=[NUM_STATE_PARAMS], mlp_layers=[1, 8])
+
+    agent.train(3)
+    assert agent.train_t == 0
+
+    feed_transitions(agent.bot, 12, 0)
+    agent.train(3)
+    agent.train(1, batch_size=12)
+    assert agent.train_t == 4
+
+@pytest.mark.parametrize('prioritized_replay', [False, True])
+def test_train_reuses_batch_buffers(prioritized_replay):
+
+    ddqn = make_ddqn(prioritized_replay=prioritized_replay)
+    feed_transitions(ddqn, 64, 0)
+
+    ddqn.train(4)
+    batch = ddqn._batch
+    states = batch['state']
+    ddqn.train(4)
+
+    assert ddqn._batch is batch
+    assert ddqn._batch['state'] is states
+
+@pytest.mark.parametrize('steps', [1, 3])
+def test_polyak_update_after_every_step(steps):
+
+    #q_net не обучается (learning_rate=0), поэтому после k шагов
+    #target = q + (1 - tau)**k * (target0 - q) независимо от update_target_net_every
+    ddqn = make_ddqn(learning_rate=0.0, tau=0.25, update_target_net_every=1000)
+    feed_transitions(ddqn, 32, 0)
+    q_weights = get_weights(ddqn.q_net)
+    target_weights = get_weights(ddqn.target_net)
+
+    ddqn.train(steps)
+    ddqn.train(steps)
+
+    expected = [q + 0.75 ** (2 * steps) * (t - q) for q, t in zip(q_weights, target_weights)]
+    assert_weights_close(get_weights(ddqn.target_net), expected)
+    assert_weights_close(get_weights(ddqn.q_net), q_weights)
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from agents.rl.utils.functions import (discounted_cumsum, returns, general_advantage_estimates,
+                                       general_advantage_estimates_tf)
+
+#исходные реализации обратным циклом, с которыми сравниваются векторные
+
+def loop_returns(rewards, dones, last_value, gamma=0.95):
+
+    result = np.zeros(len(rewards), dtype='float64')
+
+    next_value = last_value
+    for t in reversed(range(len(rewards))):
+        result[t] = rewards[t] + (1 - dones[t]) * gamma * next_value
+        next_value = result[t]
+
+    return result
+
+def loop_general_advantage_estimates(rewards, dones, values, next_values, lam, gamma=0.95):
+
+    advantages = np.zeros(len(rewards), dtype='float64')
+    lastgaelam = 0
+    for t in reversed(range(len(rewards))):
+        delta = rewards[t] + (1 - dones[t]) * gamma * next_values[t] - values[t]
+        advantages[t] = lastgaelam = delta + gamma * lam * (1 - dones[t]) * lastgaelam
+
+    return advantages + values
+
+def loop_discounted_cumsum(values, discounts):
+
+    result = np.zeros(len(values), dtype='float64')
+    next_value = 0
+    for t in reversed(range(len(values))):
+        result[t] = next_value = values[t] + discounts[t] * next_value
+
+    return result
+
+def make_episodes(length, seed, done_every=None):
+    '''
+    Случайные награды и оценки, done - в середине последовательности
+    (каждые done_every шагов) и/или на последнем шаге
+
+    '''
+    rng = np.random.default_rng(seed)
+    rewards = rng.normal(size=length).astype('float32')
+    values = rng.normal(size=length).astype('float32')
+    next_values = rng.normal(size=length).astype('float32')
+    dones = np.zeros(length, dtype='bool')
+    if done_every is not None:
+        dones[done_every - 1::done_every] = True
+
+    return rewards, dones, values, next_values
+
+#T=0, T=1, длины не степени двойки и степени двойки
+LENGTHS = [0, 1, 2, 3, 7, 16, 33, 100]
+
+@pytest.mark.parametrize('length', LENGTHS)
+@pytest.mark.parametrize('done_every', [None, 1, 3, 5])
+def test_discounted_cumsum(length, done_every):
+
+    rewards, dones, _, _ = make_episodes(length, length, done_every)
+    discounts = 0.9 * (1 - dones)
+
+    np.testing.assert_allclose(discounted_cumsum(rewards, discounts),
+                               loop_discounted_cumsum(rewards, discounts), rtol=1e-5, atol=1e-5)
+
+@pytest.mark.parametrize('length', LENGTHS)
+@pytest.mark.parametrize('done_every', [None, 1, 3, 5])
+@pytest.mark.parametrize('last_value', [0.0, 2.5])
+def test_returns(length, done_every, last_value):
+
+    rewards, dones, _, _ = make_episodes(length, length, done_every)
+
+    result = returns(rewards, dones, last_value, gamma=0.9)
+
+    assert result.shape == (length,)
+    np.testing.assert_allclose(result, loop_returns(rewards, dones, last_value, gamma=0.9), rtol=1e-5, atol=1e-5)
+
+def test_returns_bootstraps_only_unfinished_episode():
+
+    rewards = np.array([1, 0, 1, 0], dtype='float32')
+
+    #последний эпизод закончен - last_value не используется
+    finished = returns(rewards, np.array([0, 1, 0, 1]), last_value=10.0, gamma=0.5)
+    np.testing.assert_allclose(finished, [1, 0, 1, 0])
+
+    #последний эпизод не закончен - last_value дисконтируется до начала эпизода
+    unfinished = returns(rewards, np.array([0, 1, 0, 0]), last_value=10.0, gamma=0.5)
+    np.testing.assert_allclose(unfinished, [1, 0, 3.5, 5])
+
+def test_returns_does_not_modify_rewards():
+
+    rewards = np.array([1, 2, 3], dtype='float32')
+    returns(rewards, np.zeros(3), last_value=1.0)
+
+    np.testing.assert_array_equal(rewards, [1, 2, 3])
+
+@pytest.mark.parametrize('length', LENGTHS)
+@pytest.mark.parametrize('done_every', [None, 1, 3, 5])
+def test_general_advantage_estimates(length, done_every):
+
+    rewards, dones, values, next_values = make_episodes(length, length, done_every)
+
+    result = general_advantage_estimates(rewards, dones, values, next_values, 0.9, gamma=0.95)
+    expected = loop_general_advantage_estimates(rewards, dones, values, next_values, 0.9, gamma=0.95)
+
+    np.testing.assert_allclose(result, expected, rtol=1e-5, atol=1e-5)
+
+@pytest.mark.parametrize('length', LENGTHS)
+@pytest.mark.parametrize('done_every', [None, 1, 3, 5])
+def test_general_advantage_estimates_tf(length, done_every):
+
+    rewards, dones, values, next_values = make_episodes(length, length, done_every)
+
+    result = general_advantage_estimates_tf(
+        tf.constant(rewards), tf.constant(dones), tf.constant(values), tf.constant(next_values), 0.9, gamma=0.95)
+    expected = general_advantage_estimates(rewards, dones, values, next_values, 0.9, gamma=0.95)
+
+    np.testing.assert_allclose(result.numpy(), expected, rtol=1e-5, atol=1e-5)
+
+def test_general_advantage_estimates_tf_in_graph():
+
+    rewards, dones, values, next_values = make_episodes(33, 0, 5)
+
+    compiled = tf.function(lambda *args: general_advantage_estimates_tf(*args, 0.9, gamma=0.95))
+    result = compiled(tf.constant(rewards), tf.constant(dones), tf.constant(values), tf.constant(next_values))
+    expected = loop_general_advantage_estimates(rewards, dones, values, next_values, 0.9, gamma=0.95)
+
+    np.testing.assert_allclose(result.numpy(), expected, rtol=1e-5, atol=1e-5)
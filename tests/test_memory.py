@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+
+from agents.rl.utils.memory import (Replay, ReplayMemory, RingReplayMemory, PrioritizedReplayMemory,
+                                    MemmapReplayMemory, SumTree)
+
+MEMORIES = [ReplayMemory, RingReplayMemory, PrioritizedReplayMemory]
+
+def make_transitions(start, count, done_last=True):
+    '''
+    Переходы одного эпизода: состояние и награда - номер шага,
+    done - только на последнем шаге (если done_last)
+
+    '''
+    transitions = []
+    for i in range(start, start + count):
+        done = done_last and i == start + count - 1
+        transitions.append({'state': np.array([i], dtype='float32'), 'action': i, 'reward': float(i),
+                            'next_state': np.array([i + 1], dtype='float32'), 'done': done})
+
+    return transitions
+
+@pytest.mark.parametrize('memory_class', MEMORIES)
+def test_clear_mid_episode_drops_pending(memory_class):
+
+    memory = memory_class(max_replay_num=100, min_replay_num=1, n_step=3, gamma=0.5)
+
+    #эпизод не закончен - последние n - 1 переходов ждут продолжения
+    for replay in make_transitions(0, 5, done_last=False):
+        memory.add_transition(replay)
+    assert memory.size == 3
+
+    memory.clear()
+    assert memory.size == 0
+
+    #новый эпизод не должен дополняться переходами старого
+    for replay in make_transitions(100, 2):
+        memory.add_transition(replay)
+    samples = memory.get_samples()
+
+    np.testing.assert_array_equal(samples['state'].reshape(-1), [100, 101])
+    np.testing.assert_array_equal(samples['next_state'].reshape(-1), [102, 102])
+    np.testing.assert_allclose(samples['reward'], [100 + 0.5 * 101, 101])
+    np.testing.assert_array_equal(samples['done'], [True, True])
+
+@pytest.mark.parametrize('memory_class', MEMORIES)
+def test_clear_mid_batch_drops_pending(memory_class):
+
+    memory = memory_class(max_replay_num=100, min_replay_num=1, n_step=3, gamma=0.5)
+
+    memory.add_transition_batch([tuple(replay.values()) for replay in make_transitions(0, 4, done_last=False)])
+    memory.clear()
+    memory.add_transition_batch([tuple(replay.values()) for replay in make_transitions(100, 4)])
+    samples = memory.get_samples()
+
+    assert memory.size == 4
+    np.testing.assert_array_equal(samples['state'].reshape(-1), [100, 101, 102, 103])
+
+@pytest.mark.parametrize('n_step', [1, 3])
+def test_memmap_add_transition_respects_flush_every(tmp_path, monkeypatch, n_step):
+
+    memory = MemmapReplayMemory(str(tmp_path), max_replay_num=100, min_replay_num=1, flush_every=20, n_step=n_step)
+    flushes = []
+    monkeypatch.setattr(memory, 'flush', lambda: flushes.append(memory.total_replays))
+
+    for replay in make_transitions(0, 50):
+        memory.add_transition(replay)
+
+    assert memory.total_replays == 50
+    assert len(flushes) == 2
+
+def make_batch(start, count):
+    '''
+    Словарь массивов по полям записи (см. make_transitions)
+
+    '''
+    transitions = make_transitions(start, count, done_last=False)
+
+    return {key: np.asarray([replay[key] for replay in transitions]) for key in Replay._fields}
+
+def stored_states(memory):
+
+    return memory.get_samples()['state'].reshape(-1).tolist()
+
+def test_ring_add_replay_wraps_around():
+
+    memory = RingReplayMemory(max_replay_num=5, min_replay_num=1)
+    for replay in make_transitions(0, 8, done_last=False):
+        memory.add_replay(replay)
+
+    assert memory.size == 5
+    assert memory.capacity == 5
+    assert memory.cursor == 3
+    assert memory.total_replays == 8
+    #старые записи перезаписаны, порядок - от самой старой
+    assert stored_states(memory) == [3, 4, 5, 6, 7]
+    samples = memory.get_samples()
+    np.testing.assert_array_equal(samples['next_state'].reshape(-1), [4, 5, 6, 7, 8])
+    np.testing.assert_array_equal(samples['action'], [3, 4, 5, 6, 7])
+
+@pytest.mark.parametrize('first, second', [(3, 4), (5, 2), (0, 5), (2, 12), (4, 1)])
+def test_ring_add_replay_batch_wraps_around(first, second):
+
+    memory = RingReplayMemory(max_replay_num=5, min_replay_num=1)
+    memory.add_replay_batch(make_batch(0, first))
+    memory.add_replay_batch(make_batch(first, second))
+
+    total = first + second
+    assert memory.size == min(total, 5)
+    assert memory.total_replays == total
+    assert stored_states(memory) == list(range(max(0, total - 5), total))
+
+def test_ring_batch_and_single_adds_match():
+
+    memory1 = RingReplayMemory(max_replay_num=7, min_replay_num=1)
+    memory2 = RingReplayMemory(max_replay_num=7, min_replay_num=1)
+    for start, count in [(0, 3), (3, 6), (9, 1), (10, 9)]:
+        memory1.add_replay_batch(make_batch(start, count))
+        for replay in make_transitions(start, count, done_last=False):
+            memory2.add_replay(replay)
+
+    for key, value in memory1.get_samples().items():
+        np.testing.assert_array_equal(value, memory2.get_samples()[key])
+
+def test_ring_grows_when_unbounded():
+
+    memory = RingReplayMemory(max_replay_num=-1, min_replay_num=1, init_capacity=2)
+    for replay in make_transitions(0, 3, done_last=False):
+        memory.add_replay(replay)
+    assert memory.capacity == 4
+
+    memory.add_replay_batch(make_batch(3, 6))
+    assert memory.capacity == 16
+    for replay in make_transitions(9, 8, done_last=False):
+        memory.add_replay(replay)
+
+    #записи не перезаписываются, порядок сохраняется
+    assert memory.capacity == 32
+    assert memory.size == 17
+    assert stored_states(memory) == list(range(17))
+
+def test_ring_random_samples_after_full():
+
+    memory = RingReplayMemory(max_replay_num=10, min_replay_num=1)
+    memory.add_replay_batch(make_batch(0, 25))
+    out = memory.get_batch_buffers(200)
+
+    samples = memory.get_random_samples(200, out=out)
+
+    #результат пишется в переданные массивы
+    assert samples is out
+    assert samples['state'].shape == (200, 1)
+    #только записи, оставшиеся в буфере, поля - от одной записи
+    states = samples['state'].reshape(-1)
+    assert set(states.tolist()) <= set(range(15, 25))
+    np.testing.assert_array_equal(samples['next_state'].reshape(-1), states + 1)
+    np.testing.assert_array_equal(samples['action'], states)
+    np.testing.assert_array_equal(samples['reward'], states)
+
+def test_ring_pop_samples_clears():
+
+    memory = RingReplayMemory(max_replay_num=4, min_replay_num=1)
+    memory.add_replay_batch(make_batch(0, 6))
+
+    samples = memory.pop_samples()
+
+    assert samples['state'].reshape(-1).tolist() == [2, 3, 4, 5]
+    assert memory.size == 0
+    memory.add_replay_batch(make_batch(10, 2))
+    assert stored_states(memory) == [10, 11]
+
+@pytest.mark.parametrize('capacity', [1, 4, 5, 13])
+def test_sum_tree_find(capacity):
+
+    tree = SumTree(capacity)
+    priorities = np.arange(1, capacity + 1, dtype='float64')
+    tree.update(np.arange(capacity), priorities)
+
+    assert tree.total() == pytest.approx(priorities.sum())
+    np.testing.assert_array_equal(tree.get(np.arange(capacity)), priorities)
+
+    #левая и правая границы отрезка каждого листа
+    bounds = np.concatenate([[0], np.cumsum(priorities)])
+    np.testing.assert_array_equal(tree.find(bounds[:-1]), np.arange(capacity))
+    np.testing.assert_array_equal(tree.find(bounds[1:] - 1e-9), np.arange(capacity))
+
+def test_sum_tree_update_keeps_sums():
+
+    tree = SumTree(6)
+    tree.update(np.arange(6), np.ones(6))
+    tree.update([4, 1, 4], [5.0, 0.0, 5.0])
+
+    assert tree.total() == pytest.approx(9.0)
+    np.testing.assert_array_equal(tree.find([0.5, 1.5, 7.5, 8.5]), [0, 2, 4, 5])
+
+    tree.clear()
+    assert tree.total() == 0
+
+def make_prioritized_memory(count, **kwargs):
+
+    memory = PrioritizedReplayMemory(max_replay_num=count, min_replay_num=1, **kwargs)
+    memory.add_replay_batch(make_batch(0, count))
+
+    return memory
+
+def test_prioritized_sampling_distribution():
+
+    np.random.seed(0)
+    memory = make_prioritized_memory(4, alpha=0.5, epsilon=0.0)
+    memory.update_priorities(np.arange(4), np.array([1.0, 4.0, 9.0, 0.0]))
+
+    counts = np.zeros(4)
+    for _ in range(200):
+        samples = memory.get_random_samples(50)
+        counts += np.bincount(samples['state'].reshape(-1).astype('int64'), minlength=4)
+
+    #вероятность пропорциональна priority**alpha
+    np.testing.assert_allclose(counts / counts.sum(), [1 / 6, 2 / 6, 3 / 6, 0], atol=0.01)
+
+def test_prioritized_samples_match_indices():
+
+    memory = make_prioritized_memory(8)
+    memory.add_replay_batch(make_batch(8, 3))
+
+    samples = memory.get_random_samples(64)
+
+    #'index' - позиции буфера выбранных записей
+    np.testing.assert_array_equal(memory.memory['state'][samples['index']], samples['state'])
+
+def test_prioritized_samples_are_shuffled():
+
+    np.random.seed(0)
+    memory = make_prioritized_memory(100)
+
+    ids = memory.get_random_samples(100)['index']
+
+    #отрезки выборки перемешаны: первая половина батча не только из
+    #первой половины памяти
+    assert ids[:50].max() >= 50
+    assert sorted(ids.tolist()) != ids.tolist()
+
+def test_prioritized_update_priorities():
+
+    memory = make_prioritized_memory(4, alpha=0.5, epsilon=0.01)
+    assert memory.max_priority == 1.0
+    np.testing.assert_allclose(memory.tree.get(np.arange(4)), np.ones(4))
+
+    memory.update_priorities(np.array([1, 2]), np.array([-3.0, 0.0]))
+
+    np.testing.assert_allclose(memory.tree.get(np.arange(4)), [1, np.sqrt(3.01), np.sqrt(0.01), 1])
+    assert memory.max_priority == pytest.approx(3.01)
+    assert memory.tree.total() == pytest.approx(2 + np.sqrt(3.01) + np.sqrt(0.01))
+
+    #новые записи получают максимальный приоритет
+    memory.add_replay(make_transitions(4, 1)[0])
+    memory.add_replay_batch(make_batch(5, 2))
+    ids = memory._indices(np.arange(1, 4))
+    np.testing.assert_allclose(memory.tree.get(ids), np.full(3, np.sqrt(3.01)))
+
+def test_prioritized_importance_sampling_weights():
+
+    memory = make_prioritized_memory(4, alpha=1.0, beta=0.5, beta_increment=0.25, epsilon=0.0)
+    memory.update_priorities(np.arange(4), np.array([1.0, 2.0, 3.0, 4.0]))
+
+    samples = memory.get_random_samples(16)
+
+    #w = (N * P(i)) ** -beta, нормированы на максимум
+    probs = samples['index'].astype('float64') + 1
+    probs /= 10
+    expected = (4 * probs) ** -0.5
+    np.testing.assert_allclose(samples['weight'], expected / expected.max(), rtol=1e-6)
+    assert samples['weight'].dtype == np.float32
+    assert memory.beta == 0.75
+
+    #beta растёт после каждой выборки до 1
+    memory.get_random_samples(16)
+    memory.get_random_samples(16)
+    assert memory.beta == 1.0
+
+def test_prioritized_clear_resets_priorities():
+
+    memory = make_prioritized_memory(4)
+    memory.update_priorities(np.arange(4), np.full(4, 5.0))
+
+    memory.clear()
+
+    assert memory.tree.total() == 0
+    assert memory.max_priority == 1.0
+    memory.add_replay_batch(make_batch(0, 2))
+    assert memory.tree.total() == pytest.approx(2.0)
+
+def assert_same_samples(memory1, memory2):
+
+    samples1 = memory1.get_samples()
+    samples2 = memory2.get_samples()
+    for key in samples1.keys():
+        np.testing.assert_array_equal(samples1[key], samples2[key])
+
+def test_memmap_reopen_restores_contents_and_meta(tmp_path):
+
+    path = str(tmp_path / 'memory')
+    memory = MemmapReplayMemory(path, max_replay_num=6, min_replay_num=1, flush_every=1000)
+    memory.add_replay_batch(make_batch(0, 4))
+    for replay in make_transitions(4, 5, done_last=True):
+        memory.add_replay(replay)
+    memory.flush()
+
+    reopened = MemmapReplayMemory(path, max_replay_num=100)
+
+    #размер берётся из meta.json, а не из max_replay_num
+    assert reopened.capacity == 6
+    assert reopened.max_replay_num == 6
+    assert (reopened.cursor, reopened.size, reopened.total_replays) == (3, 6, 9)
+    assert stored_states(reopened) == [3, 4, 5, 6, 7, 8]
+    assert_same_samples(memory, reopened)
+
+    #открытый заново буфер продолжает запись с курсора
+    reopened.add_replay_batch(make_batch(9, 2))
+    assert stored_states(reopened) == [5, 6, 7, 8, 9, 10]
+
+def test_memmap_reopen_sees_only_flushed_records(tmp_path):
+
+    path = str(tmp_path / 'memory')
+    memory = MemmapReplayMemory(path, max_replay_num=8, min_replay_num=1, flush_every=3)
+    for replay in make_transitions(0, 4):
+        memory.add_replay(replay)
+
+    #meta.json записан после третьей записи
+    reader = MemmapReplayMemory(path, mode='r')
+    assert stored_states(reader) == [0, 1, 2]
+
+    memory.flush()
+    reader.refresh()
+    assert_same_samples(memory, reader)
+
+    with pytest.raises(ValueError):
+        reader.add_replay_batch(make_batch(0, 1))
+
+def test_memmap_new_buffer_overwrites(tmp_path):
+
+    path = str(tmp_path / 'memory')
+    memory = MemmapReplayMemory(path, max_replay_num=4, min_replay_num=1)
+    memory.add_replay_batch(make_batch(0, 3))
+    memory.flush()
+
+    memory = MemmapReplayMemory(path, max_replay_num=5, mode='w+')
+    assert memory.size == 0
+    memory.add_replay_batch(make_batch(10, 2))
+    memory.flush()
+
+    reopened = MemmapReplayMemory(path)
+    assert reopened.capacity == 5
+    assert stored_states(reopened) == [10, 11]
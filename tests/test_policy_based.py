@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+
+from agents.rl.policy_based import PolicyBased
+
+NUM_STATE_PARAMS = 4
+NUM_ACTIONS = 3
+
+def loop_acc_rewards(rewards, dones, gamma):
+    '''
+    Награды до конца эпизода и нормировка - отдельно для каждого эпизода
+
+    '''
+    result = np.zeros(len(rewards), dtype='float64')
+    start = 0
+    for end in np.flatnonzero(dones) + 1:
+        reward_sum = 0
+        for t in reversed(range(start, end)):
+            reward_sum = rewards[t] + gamma * reward_sum
+            result[t] = reward_sum
+        std = np.std(result[start:end])
+        result[start:end] = (result[start:end] - np.mean(result[start:end])) / (std if std != 0 else 1)
+        start = end
+
+    return result
+
+def make_bot():
+
+    return PolicyBased(NUM_STATE_PARAMS, NUM_ACTIONS, [8], gamma=0.9)
+
+@pytest.mark.parametrize('lengths', [[1], [5], [3, 1, 4], [2, 2, 2, 2], [7, 1, 1, 6]])
+def test_acc_rewards_per_episode(lengths):
+
+    rng = np.random.default_rng(len(lengths))
+    rewards = rng.normal(size=sum(lengths)).astype('float32')
+    dones = np.zeros(sum(lengths), dtype='bool')
+    dones[np.cumsum(lengths) - 1] = True
+
+    result = make_bot()._calc_acc_rewards(rewards, dones)
+
+    np.testing.assert_allclose(result, loop_acc_rewards(rewards, dones, 0.9), rtol=1e-5, atol=1e-5)
+    #каждый эпизод нормирован отдельно
+    for episode in np.split(result, np.cumsum(lengths)[:-1]):
+        assert abs(np.mean(episode)) < 1e-5
+        assert np.std(episode) == pytest.approx(1.0 if len(episode) > 1 else 0.0, abs=1e-5)
+
+def test_acc_rewards_does_not_cross_episodes():
+
+    bot = make_bot()
+    #одинаковые эпизоды дают одинаковые нормированные награды,
+    #независимо от наград соседнего эпизода
+    rewards = np.array([1, 0, 2, 1, 0, 2, 100, -50], dtype='float32')
+    dones = np.array([0, 0, 1, 0, 0, 1, 0, 1], dtype='bool')
+
+    result = bot._calc_acc_rewards(rewards, dones)
+
+    np.testing.assert_allclose(result[:3], result[3:6], rtol=1e-6)
+    np.testing.assert_allclose(result[:3], bot._calc_acc_rewards(rewards[:3], dones[:3]), rtol=1e-6)
+
+def test_train_does_not_retrace():
+
+    bot = make_bot()
+    rng = np.random.default_rng(0)
+
+    for count in [5, 12, 1, 30]:
+        for t in range(count):
+            bot.feed(rng.normal(size=NUM_STATE_PARAMS), rng.integers(NUM_ACTIONS), rng.normal(), done=t % 4 == 3)
+        bot.train()
+        bot.clear_memory()
+        if count == 5:
+            trace_counts = dict(bot.trace_counts)
+
+    assert bot.trace_counts == trace_counts
+    assert bot.train_step == 4
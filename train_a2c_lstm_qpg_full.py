@@ -20,6 +20,8 @@ from agents.A2CQPGAgent import A2CQPGAgent
 from agents.A2CLSTMAgent import A2CLSTMAgent
 from agents.A2CLSTMQPGAgent import A2CLSTMQPGAgent
 from agents.testAgents import FoldAgent
+from agents.rl.utils.evaluation import AsyncEvaluator
+from agents.rl.utils.rollout import BatchedRollout
 
 def createParser():
     parser = argparse.ArgumentParser()
@@ -33,6 +35,7 @@ def createParser():
     parser.add_argument('-rs', '--random_seed', default = 0, type=int)
     
     parser.add_argument('-lm', '--load_model', default = None)
+    parser.add_argument('-ew', '--eval_workers', default = 1, type=int)
     
     return  parser
 
@@ -161,7 +164,7 @@ def main():
                      
                      max_grad_norm = 1,)  
    
-    agent_test = A2CLSTMQPGAgent(
+    agent_kwargs = dict(
                      action_num=eval_env.action_num,
                      state_shape=eval_env.state_shape,
                      
@@ -186,6 +189,8 @@ def main():
                      
                      max_grad_norm = 1,)  
     
+    agent_test = A2CLSTMQPGAgent(**agent_kwargs)
+    
     if namespace.load_model is not None:
         agent_test.load_model(namespace.load_model)
     agent_ddqn.load_model('models/rl/no_limit_holdem_ddqn_result/test0')
@@ -204,6 +209,13 @@ def main():
     # Init a Logger to plot the learning curve
     logger = Logger(log_dir+'/'+test_name)
     
+    # Evaluate in background processes on a snapshot of the weights
+    evaluator = None
+    if namespace.eval_workers > 0:
+        evaluator = AsyncEvaluator(env_name, A2CLSTMQPGAgent, agent_kwargs, evaluate_num, logger,
+                                   workers_num=namespace.eval_workers,
+                                   seed=random_seed)
+    
     envs = [env_rand, 
             env_ddqn, 
             env_qpg,
@@ -212,16 +224,15 @@ def main():
             ]
     
     env_num = len(envs)
+    rollout = BatchedRollout(envs)
     for episode in range(episode_num // env_num):
 
-        # Generate data from the
-        for env in envs:
-            trajectories, _ = env.run(is_training=True)
-            #agent_test.reset_lstm_memory()
+        # Generate data from the tables in lockstep, one batched decision per agent
+        trajectories, _, _ = rollout.run(is_training=True)
+        for table_trajectories in trajectories:
 
             # Feed transitions into agent memory, and train the agent
-            for ts in trajectories[0]:
-                agent_test.feed(ts)
+            agent_test.feed_trajectory(table_trajectories[0])
             
         if episode % (train_every // env_num) == 0:
             agent_test.train()
@@ -235,9 +246,19 @@ def main():
         # Evaluate the performance. Play with random agents.
         if episode % (evaluate_every // env_num) == 0:
             print('episode: ', episode*env_num)
-            logger.log_performance(episode*env_num, tournament(eval_env, evaluate_num)[0])
+            if evaluator is not None:
+                evaluator.submit(episode*env_num, agent_test.get_weights())
+            else:
+                logger.log_performance(episode*env_num, tournament(eval_env, evaluate_num)[0])
+        
+        # Log the evaluations finished in the background
+        if evaluator is not None:
+            evaluator.poll()
 
 
+    if evaluator is not None:
+        evaluator.close()
+    
     # Close files in the logger
     logger.close_files()
 
@@ -20,6 +20,9 @@ from agents.A2CQPGAgent import A2CQPGAgent
 from agents.A2CLSTMAgent import A2CLSTMAgent
 from agents.A2CLSTMQPGAgent import A2CLSTMQPGAgent
 from agents.testAgents import FoldAgent
+from agents.rl.utils.evaluation import AsyncEvaluator
+from agents.rl.utils.actors import ActorPool
+from agents.rl.utils.memory import SharedReplayMemory
 
 def createParser():
     parser = argparse.ArgumentParser()
@@ -33,6 +36,10 @@ def createParser():
     parser.add_argument('-rs', '--random_seed', default = 0, type=int)
     
     parser.add_argument('-lm', '--load_model', default = None)
+    parser.add_argument('-ew', '--eval_workers', default = 1, type=int)
+    parser.add_argument('-aw', '--actor_workers', default = 0, type=int)
+    parser.add_argument('-be', '--broadcast_every', default = 1, type=int)
+    parser.add_argument('-sr', '--shared_replay', action='store_true')
     
     return  parser
     
@@ -76,7 +83,7 @@ def main():
     
     agent_rand = RandomAgent(action_num=eval_env.action_num)    
     
-    agent_test = A2CLSTMQPGAgent(
+    agent_kwargs = dict(
                      action_num=eval_env.action_num,
                      state_shape=eval_env.state_shape,
                      
@@ -101,6 +108,11 @@ def main():
                      
                      max_grad_norm = 1,)  
     
+    if namespace.shared_replay:
+        # Actors write transitions straight into the learner's replay memory
+        agent_kwargs['shared_memory'] = SharedReplayMemory(eval_env.state_shape)
+    agent_test = A2CLSTMQPGAgent(**agent_kwargs)
+    
     if namespace.load_model is not None:
         agent_test.load_model(namespace.load_model)
     
@@ -111,22 +123,47 @@ def main():
     # Init a Logger to plot the learning curve
     logger = Logger(log_dir+'/'+test_name)
     
+    # Evaluate in background processes on a snapshot of the weights
+    evaluator = None
+    if namespace.eval_workers > 0:
+        evaluator = AsyncEvaluator(env_name, A2CLSTMQPGAgent, agent_kwargs, evaluate_num, logger,
+                                   workers_num=namespace.eval_workers,
+                                   seed=random_seed)
+    
     envs = [env_rand, 
             ]
     
     env_num = len(envs)
+    
+    # Actor-learner mode: games are played by worker processes with 
+    # inference-only copies of the agent, weights are sent every few updates
+    pool = None
+    if namespace.actor_workers > 0:
+        pool = ActorPool(env_name, A2CLSTMQPGAgent, agent_kwargs,
+                         workers_num=namespace.actor_workers,
+                         broadcast_every=namespace.broadcast_every,
+                         seed=random_seed)
+        pool.start(agent_test.get_weights())
+    
     for episode in range(episode_num // env_num):
 
         # Generate data from the
-        for env in envs:
-            trajectories, _ = env.run(is_training=True)
+        if pool is not None:
+            trajectories, _, _ = pool.get_trajectories(min_num=env_num, max_num=env_num)
+        else:
+            trajectories = [env.run(is_training=True)[0] for env in envs]
+            
+        for table_trajectories in trajectories:
+            if table_trajectories is None:
+                continue
 
             # Feed transitions into agent memory, and train the agent
-            for ts in trajectories[0]:
-                agent_test.feed(ts)
+            agent_test.feed_trajectory(table_trajectories[0])
             
         if episode % (train_every // env_num) == 0:
             agent_test.train()
+            if pool is not None:
+                pool.update_weights(agent_test.get_weights())
         
         if episode % (save_every // env_num) == 0 :
             # Save model
@@ -137,9 +174,24 @@ def main():
         # Evaluate the performance. Play with random agents.
         if episode % (evaluate_every // env_num) == 0:
             print('episode: ', episode*env_num)
-            logger.log_performance(episode*env_num, tournament(eval_env, evaluate_num)[0])
+            if evaluator is not None:
+                evaluator.submit(episode*env_num, agent_test.get_weights())
+            else:
+                logger.log_performance(episode*env_num, tournament(eval_env, evaluate_num)[0])
+        
+        # Log the evaluations finished in the background
+        if evaluator is not None:
+            evaluator.poll()
 
 
+    if pool is not None:
+        pool.stop()
+    if namespace.shared_replay:
+        agent_kwargs['shared_memory'].unlink()
+
+    if evaluator is not None:
+        evaluator.close()
+    
     # Close files in the logger
     logger.close_files()
 